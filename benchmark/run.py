@@ -0,0 +1,340 @@
+""" Benchmark ngwdocker generation and archivist on synthetic fixtures.
+
+Generation fixture is a project with N packages, each one is a git repository
+with M files. Archivist fixture is a data tree with configurable file count and
+size. Each phase is run several times and its median is compared against
+baseline stored on the same machine, CLI module import time (-X importtime)
+is also checked against absolute budget. Docker is not required, archivist
+requires tar and zstd executables.
+
+    $ python benchmark/run.py --update
+    $ python benchmark/run.py
+
+"""
+
+import io
+import os
+import sys
+import json
+import subprocess
+from contextlib import contextmanager
+from collections import OrderedDict
+from pathlib import Path
+from shutil import rmtree
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter, process_time
+
+import click
+from loguru import logger
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'ngwdocker' / 'archivist'))
+
+from ngwdocker.context import Context  # NOQA: E402
+from ngwdocker.util import copyfiles, git_ls_files, tree_digest  # NOQA: E402
+
+import archivist  # NOQA: E402
+
+DOCKER_PY = """from ngwdocker import PackageBase
+
+
+class Package(PackageBase):
+    pass
+"""
+
+SETUP_PY = """from setuptools import setup
+
+setup(name='{}')
+"""
+
+# PostgreSQL binaries replaced with scripts for postgres-initdb check, pg_ctl
+# fails like server does if a file included from postgresql.conf is missing.
+PG_STUBS = dict(
+    initdb="""#!/bin/bash
+while [ $# -gt 0 ]; do [ "$1" = "--pgdata" ] && PGDATA="$2"; shift; done
+mkdir -p "$PGDATA"
+echo "#listen_addresses = 'localhost'" > "$PGDATA/postgresql.conf"
+echo "host all all 127.0.0.1/32 md5" > "$PGDATA/pg_hba.conf"
+echo 10 > "$PGDATA/PG_VERSION"
+""",
+    pg_ctl="""#!/bin/bash
+[ "$4" = "start" ] || exit 0
+sed -n "s/^include '\\(.*\\)'$/\\1/p" "$2/postgresql.conf" | while read -r fn; do
+    [ -f "$fn" ] || { echo "could not open configuration file $fn" >&2; exit 1; }
+done
+""",
+    psql="""#!/bin/bash
+cat > /dev/null
+""")
+
+
+class Timings:
+    """ Samples of each phase, results are medians """
+
+    def __init__(self):
+        self.samples = OrderedDict()
+
+    def add(self, name, wall, cpu):
+        self.samples.setdefault(name, list()).append((wall, cpu))
+
+    @contextmanager
+    def phase(self, name):
+        wall, cpu = perf_counter(), process_time()
+        yield
+        self.add(name, perf_counter() - wall, process_time() - cpu)
+
+    @property
+    def results(self):
+        return OrderedDict(
+            (name, OrderedDict(
+                wall=median(s[0] for s in samples),
+                cpu=median(s[1] for s in samples)))
+            for name, samples in self.samples.items())
+
+
+def git(path, *args):
+    subprocess.check_call(
+        ['git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost']
+        + list(args), cwd=str(path), stdout=subprocess.DEVNULL)
+
+
+def generation_fixture(path, packages, files, file_size):
+    """ Project with nextgisweb and packages-1 additional packages """
+    pnames = ['nextgisweb'] + ['nextgisweb_bench{:03d}'.format(i) for i in range(1, packages)]
+    for pname in pnames:
+        pkg = path / 'package' / pname
+        (pkg / pname).mkdir(parents=True)
+        (pkg / 'VERSION').write_text('3.5.0\n')
+        (pkg / 'setup.py').write_text(SETUP_PY.format(pname))
+        (pkg / 'docker.py').write_text(DOCKER_PY)
+
+        for i in range(files):
+            subdir = pkg / pname / 'mod{:02d}'.format(i % 20)
+            subdir.mkdir(exist_ok=True)
+            (subdir / 'file{:05d}.py'.format(i)).write_bytes(os.urandom(file_size))
+
+        git(pkg, 'init', '-q')
+        git(pkg, 'add', '.')
+        git(pkg, 'commit', '-q', '-m', 'benchmark')
+
+    with io.open(path / 'ngwdocker.yaml', 'w') as fd:
+        fd.write('mode: production\n')
+
+
+def archivist_fixture(path, files, file_size):
+    for root in ('data/app', 'data/postgres', 'config/app', 'config/postgres', 'secret'):
+        (path / root).mkdir(parents=True)
+
+    for i in range(files):
+        subdir = path / 'data' / ('app' if i % 2 else 'postgres') / 'd{:03d}'.format(i % 100)
+        subdir.mkdir(exist_ok=True)
+        (subdir / 'f{:06d}'.format(i)).write_bytes(os.urandom(file_size))
+
+    (path / 'secret' / 'postgres').write_text('secret')
+    (path / 'backup').mkdir()
+
+
+def bench_generation(timings, path):
+    cwd = os.getcwd()
+    os.chdir(str(path))
+    try:
+        # Each run starts without build directory
+        rmtree('build', ignore_errors=True)
+        with timings.phase('generation.from_file'):
+            context = Context.from_file(Path('ngwdocker.yaml'))
+        with timings.phase('generation.load_packages'):
+            context.load_packages()
+        with timings.phase('generation.initialize'):
+            context.initialize()
+
+        # Identical inputs should give identical build contexts and compose
+        # file, also if only some images are regenerated (ngwdocker watch)
+        digest = tree_digest(context.build_path)
+        compose = Path('docker-compose.yaml').read_text()
+        context = Context.from_file(Path('ngwdocker.yaml'))
+        context.load_packages()
+        context.initialize()
+        reproducible = digest == tree_digest(context.build_path)
+
+        partial = list(context.images)[:1]
+        context = Context.from_file(Path('ngwdocker.yaml'))
+        context.load_packages()
+        context.initialize(images=partial)
+        reproducible = reproducible and \
+            digest == tree_digest(context.build_path) and \
+            compose == Path('docker-compose.yaml').read_text()
+
+        with TemporaryDirectory() as tmp, timings.phase('generation.copyfiles'):
+            for package in context.packages.values():
+                if (package.path / 'setup.py').exists():
+                    copyfiles(git_ls_files(package.path), Path(tmp) / package.name, package.path)
+    finally:
+        os.chdir(cwd)
+
+    return reproducible
+
+
+def check_postgres_template():
+    """ Cluster template is initialized during image build when config
+    directory isn't unpacked yet, so server must start without it """
+
+    bin_src = ROOT / 'ngwdocker' / 'base' / 'image' / 'postgres' / 'bin'
+    with TemporaryDirectory() as tmp:
+        ngwroot = Path(tmp) / 'ngw'
+        copyfiles([bin_src, ], ngwroot / 'bin', bin_src)
+        for name, content in PG_STUBS.items():
+            (ngwroot / 'stubs' / name).parent.mkdir(exist_ok=True)
+            (ngwroot / 'stubs' / name).write_text(content)
+        for fn in list((ngwroot / 'bin').iterdir()) + list((ngwroot / 'stubs').iterdir()):
+            fn.chmod(0o755)
+
+        env = dict(
+            os.environ, NGWROOT=str(ngwroot), POSTGRES_MAJOR='none',
+            PATH=str(ngwroot / 'stubs') + os.pathsep + os.environ['PATH'])
+        return subprocess.call(
+            [str(ngwroot / 'bin' / 'postgres-initdb'), str(Path(tmp) / 'template'),
+             '--database', ''], env=env, stdout=subprocess.DEVNULL) == 0
+
+
+def bench_archivist(timings, path):
+    cwd = os.getcwd()
+    os.chdir(str(path))
+    try:
+        if os.path.isfile('backup/benchmark.tar.zst'):
+            os.unlink('backup/benchmark.tar.zst')
+        with timings.phase('archivist.backup'):
+            archivist.backup('backup/benchmark.tar.zst')
+        with timings.phase('archivist.verify'):
+            problems = archivist.verify('backup/benchmark.tar.zst')
+        if len(problems) > 0:
+            raise RuntimeError("Benchmark archive is damaged: {}".format(problems))
+        with timings.phase('archivist.restore'):
+            archivist.restore('backup/benchmark.tar.zst', base=path)
+    finally:
+        os.chdir(cwd)
+
+
+def bench_startup(timings):
+    """ Cumulative import time of CLI module reported by -X importtime """
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import ngwdocker.script'],
+        env=env, stderr=subprocess.STDOUT, universal_newlines=True)
+
+    for line in output.splitlines():
+        parts = [p.strip() for p in line.split('|')]
+        if len(parts) == 3 and parts[2] == 'ngwdocker.script':
+            value = int(parts[1]) / 1e6
+            timings.add('startup.import', value, value)
+            return value
+
+    raise RuntimeError("Module ngwdocker.script not found in importtime output")
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """ Phase is a regression if its median is slower than baseline both
+    relatively (tolerance) and absolutely (min_delta seconds), so timer noise
+    of short phases isn't reported. """
+
+    regressions = 0
+    for name, value in results.items():
+        line = '{:<28} {:>9.3f}s wall {:>9.3f}s cpu'.format(
+            name, value['wall'], value['cpu'])
+        base = baseline.get(name)
+        if base is not None:
+            ratio = value['wall'] / base['wall'] if base['wall'] > 0 else 1
+            line += '  {:>6.2f}x baseline'.format(ratio)
+            if ratio > tolerance and value['wall'] - base['wall'] > min_delta:
+                line += '  REGRESSION'
+                regressions += 1
+        click.echo(line)
+    return regressions
+
+
+@click.command()
+@click.option('--packages', default=10, help="Number of packages in generation fixture.")
+@click.option('--files', default=200, help="Number of files in each package.")
+@click.option('--file-size', default=2048, help="Size of each package file in bytes.")
+@click.option('--archive-files', default=2000, help="Number of files in archivist fixture.")
+@click.option('--archive-size', default=16384, help="Size of each archivist file in bytes.")
+@click.option('--baseline', default=str(Path(__file__).parent / 'baseline.json'),
+              type=click.Path(dir_okay=False), help="Baseline file.")
+@click.option('--repeat', default=3, help="Number of runs, medians are compared.")
+@click.option('--tolerance', default=1.5, help="Maximum allowed ratio to baseline.")
+@click.option('--min-delta', default=0.05,
+              help="Minimum slowdown in seconds to report regression.")
+@click.option('--update', is_flag=True, help="Store results as new baseline.")
+@click.option('--skip-archivist', is_flag=True, help="Skip archivist benchmarks.")
+@click.option('--startup-budget', default=100, help="Maximum CLI import time in milliseconds.")
+def main(packages, files, file_size, archive_files, archive_size,
+         baseline, repeat, tolerance, min_delta, update, skip_archivist, startup_budget):
+    logger.remove()
+
+    params = OrderedDict(
+        packages=packages, files=files, file_size=file_size,
+        archive_files=archive_files, archive_size=archive_size)
+
+    timings = Timings()
+    for i in range(repeat):
+        bench_startup(timings)
+
+    with TemporaryDirectory() as tmp:
+        gen_path = Path(tmp) / 'generation'
+        with timings.phase('fixture.generation'):
+            generation_fixture(gen_path, packages, files, file_size)
+        reproducible = all([
+            bench_generation(timings, gen_path)
+            for i in range(repeat)])
+        rmtree(str(gen_path))
+        template = check_postgres_template()
+
+        if not skip_archivist:
+            arc_path = Path(tmp) / 'archivist'
+            with timings.phase('fixture.archivist'):
+                archivist_fixture(arc_path, archive_files, archive_size)
+            for i in range(repeat):
+                bench_archivist(timings, arc_path)
+
+    results = OrderedDict(
+        (k, v) for k, v in timings.results.items()
+        if not k.startswith('fixture.'))
+
+    # Baseline is specific to the machine, so it isn't stored in repository
+    baseline_path = Path(baseline)
+    stored = dict()
+    if baseline_path.is_file():
+        with io.open(baseline_path, 'r') as fd:
+            data = json.load(fd)
+        if data['params'] == params:
+            stored = data['results']
+        else:
+            click.echo("Baseline parameters differ, comparison skipped.")
+    elif not update:
+        click.echo("No baseline found, store one on this machine with --update.")
+
+    startup = results['startup.import']['wall']
+    regressions = compare(results, stored, tolerance, min_delta)
+    if not reproducible:
+        click.echo("Build contexts or compose file differ between runs")
+        regressions += 1
+    if not template:
+        click.echo("Postgres cluster template can't be initialized during image build")
+        regressions += 1
+    if startup * 1000 > startup_budget:
+        click.echo("CLI import time {:.0f}ms exceeds budget {}ms".format(
+            startup * 1000, startup_budget))
+        regressions += 1
+
+    if update:
+        with io.open(baseline_path, 'w') as fd:
+            json.dump(OrderedDict(params=params, results=results), fd, indent=2)
+            fd.write('\n')
+        click.echo("Baseline stored to {}".format(baseline_path))
+    elif regressions > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,38 +2,92 @@ import sys
 import os
 import os.path
 import logging
+import threading
 import subprocess
 from datetime import datetime
 from pathlib import Path
-from tempfile import mkstemp
-from time import sleep, mktime
+from tempfile import mkstemp, TemporaryFile
+from time import time, sleep, mktime
 
 import click
 
+from .throttle import Throttle, CONTROL_FILE, format_rate, read_control, write_control
+from .daemon import Schedule, BackupLocked, backup_lock, daemon
+from .manifest import Hasher, CountingReader, write_manifest, read_manifest, compare
+
+
+def throttle_options(func):
+    func = click.option(
+        '--ionice', default=None, metavar='CLASS[:LEVEL]',
+        help="I/O scheduling class: realtime, best-effort, idle or number.")(func)
+    func = click.option(
+        '--nice', type=int, default=None,
+        help="CPU niceness of subprocesses.")(func)
+    func = click.option(
+        '--bwlimit', type=float, default=None,
+        help="Bandwidth limit in MB/s, 0 means no limit.")(func)
+    return func
+
 
 def backup_options():
     @click.argument('filename', required=False, type=click.Path())
+    @throttle_options
     def wraped(**kwargs):
+        logging.basicConfig(format='%(name)s: %(message)s', level=logging.INFO)
         return backup(**kwargs)
     return wraped
 
 
-def backup(filename):
+def backup(filename, bwlimit=None, nice=None, ionice=None):
     logger = logging.getLogger('archivist.backup')
     now = datetime.utcnow()
+    throttle = Throttle.from_env(bwlimit=bwlimit, nice=nice, ionice=ionice)
 
     if filename is None:
         filename = 'backup/archivist-' + now.strftime("%Y%m%d-%H%M%S.tar.zst")
 
     fpath = Path(filename)
+    with backup_lock(str(fpath.parent)):
+        _backup(filename, fpath, now, throttle, logger)
+    return filename
+
+
+def _backup(filename, fpath, now, throttle, logger):
     tmpf = mkstemp(dir=str(fpath.parent), prefix=fpath.name)[1]
 
     try:
         roots = ['data', 'config', 'secret']
-        subprocess.check_call(
-            ['tar', '-I', 'zstd', '-cpf', tmpf]
-            + roots)
-        
+
+        # Separate WAL volume is optional
+        if Path('wal').is_dir() and any(Path('wal').iterdir()):
+            roots.append('wal')
+
+        # Archiver and compressor are separate processes, so tar output can
+        # be throttled between them. The same stream is hashed for manifest.
+        hasher = Hasher()
+        rfd, wfd = os.pipe()
+        reader, writer = os.fdopen(rfd, 'rb'), os.fdopen(wfd, 'wb')
+        hasher_thread = threading.Thread(target=hasher.feed, args=(reader, ))
+        hasher_thread.start()
+        try:
+            with open(tmpf, 'wb') as fd:
+                nbytes, elapsed, _ = throttle.pipe(
+                    ['tar', '-cpf', '-'] + roots, ['zstd', '-q', '-c'],
+                    stdout=fd, tee=writer.write)
+        finally:
+            writer.close()
+            hasher_thread.join()
+            reader.close()
+
+        if hasher.error is not None:
+            raise RuntimeError("Failed to hash archive members: %s" % hasher.error)
+        with open(tmpf, 'ab') as fd:
+            write_manifest(fd, hasher.members)
+
+        click.echo("Archived %s, compressed to %.1f MB (%s)" % (
+            format_rate(nbytes, elapsed), float(os.path.getsize(tmpf)) / (1024 * 1024),
+            throttle.describe()), err=True)
+
         # Wait some time before checking archive
         sleep(1)
 
@@ -45,7 +99,7 @@ def backup(filename):
             check_mtime(Path(r), tstamp)
 
         # Compare archive contents with current state
-        check_tar_compare(tmpf, logger)
+        check_tar_compare(tmpf, logger, throttle)
 
         # Rename temporary file to target file name
         # and print its name to stdout.
@@ -66,14 +120,21 @@ def check_mtime(path, tstamp):
                     str(f), mtime, tstamp))
 
 
-def check_tar_compare(filename, logger):
-    subp = subprocess.Popen(
-        ['tar', '-I', 'zstd', '--compare', '-f', filename],
-        stdout=subprocess.PIPE, universal_newlines=True)
-    subp.communicate()
-    if subp.returncode != 0:
+def check_tar_compare(filename, logger, throttle=None):
+    if throttle is None:
+        throttle = Throttle()
+
+    with TemporaryFile() as output:
+        nbytes, elapsed, returncode = throttle.pipe(
+            ['zstd', '-q', '-dc', filename], ['tar', '--compare', '-f', '-'],
+            stdout=output, check=False)
+        output.seek(0)
+        lines = output.read().decode('utf-8', 'replace').split('\n')
+
+    click.echo("Verified %s" % format_rate(nbytes, elapsed), err=True)
+    if returncode != 0:
         fcount = 0
-        for line in subp.stdout.split('\n'):
+        for line in lines:
             if line == '':
                 continue
             fcount += 1
@@ -81,19 +142,88 @@ def check_tar_compare(filename, logger):
         raise RuntimeError("Comparison failed for %d files!" % fcount)
 
 
+def verify_options():
+    @click.argument('filename', type=click.Path(exists=True, dir_okay=False))
+    @click.option(
+        '--workers', type=int, default=None,
+        help="Number of hashing threads, up to 4 by default.")
+    def wraped(filename, workers):
+        logging.basicConfig(format='%(name)s: %(message)s', level=logging.INFO)
+        problems = verify(filename, workers)
+        for name, problem in problems:
+            click.echo("%s: %s" % (problem, name))
+        if len(problems) > 0:
+            raise click.ClickException(
+                "Archive %s is damaged, %d problems found!" % (filename, len(problems)))
+    return wraped
+
+
+def verify(filename, workers=None):
+    """ Decompress archive as a stream and check its members against
+    embedded manifest. Returns list of (name, problem) tuples. """
+
+    logger = logging.getLogger('archivist.verify')
+    throttle = Throttle.from_env()
+
+    problems = list()
+    try:
+        manifest = read_manifest(filename)
+    except ValueError as exc:
+        manifest = None
+        problems.append((filename, str(exc)))
+    else:
+        if manifest is None:
+            logger.warning("Archive has no manifest, only its structure is checked")
+
+    hasher = Hasher(workers)
+    start = time()
+    proc = subprocess.Popen(
+        throttle.prefix() + ['zstd', '-q', '-dc', filename],
+        stdout=subprocess.PIPE, close_fds=True)
+    reader = CountingReader(proc.stdout)
+    try:
+        hasher.feed(reader)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    elapsed = time() - start
+
+    click.echo("Verified %s, %d members, %d hashing threads" % (
+        format_rate(reader.nbytes, elapsed), len(hasher.members),
+        hasher.workers), err=True)
+
+    if proc.returncode != 0:
+        problems.append((filename, 'decompression failed'))
+    if hasher.error is not None:
+        problems.append((filename, 'tar stream error (%s)' % hasher.error))
+    if manifest is not None:
+        problems.extend(compare(manifest, hasher.members))
+    return problems
+
+
 def restore_options():
     @click.argument('filename', type=click.Path())
     def wraped(**kwargs):
-        return restore(**kwargs)
+        try:
+            return restore(**kwargs)
+        except BackupLocked as exc:
+            raise click.ClickException(str(exc))
     return wraped
 
 
-def restore(filename):
+def restore(filename, base='/opt/ngw'):
+    # Scheduled backup of partially restored data would be broken and its
+    # retention could remove good archives, so backups are locked out.
+    base = Path(base)
+    with backup_lock(str(base / 'backup')):
+        _restore(filename, base)
+
+
+def _restore(filename, base):
     lines = subprocess.check_output(
         ['tar', '-I', 'zstd', '-tf', filename],
         universal_newlines=True)
 
-    base = Path('/opt/ngw')
     mpoints = []
     rootdirs = []
 
@@ -132,7 +262,52 @@ def restore(filename):
 
     cleanup(base, rootdirs)
 
-    subprocess.check_call(['tar', '-I', 'zstd', '-xf', filename])
+    subprocess.check_call(
+        ['tar', '-I', 'zstd', '-xf', os.path.abspath(filename)],
+        cwd=str(base))
+
+
+@click.command('throttle')
+@throttle_options
+@click.option('--reset', is_flag=True, help="Remove limits set by this command.")
+def throttle_command(bwlimit, nice, ionice, reset):
+    """ Change limits of running and future backups """
+
+    if reset and os.path.isfile(CONTROL_FILE):
+        os.unlink(CONTROL_FILE)
+
+    limits = read_control(CONTROL_FILE) if os.path.isfile(CONTROL_FILE) else dict()
+    changes = dict((k, v) for k, v in (
+        ('bwlimit', bwlimit), ('nice', nice), ('ionice', ionice)
+    ) if v is not None)
+    limits.update(changes)
+
+    effective = Throttle.from_env()
+    try:
+        effective.update(dict(effective.defaults, **limits))
+    except ValueError as exc:
+        raise click.UsageError(str(exc))
+
+    if len(changes) > 0:
+        write_control(CONTROL_FILE, limits)
+    click.echo(effective.describe())
+
+
+@click.command('daemon')
+@click.option(
+    '--schedule', 'schedules', multiple=True, type=(str, str, int),
+    metavar='NAME CRON KEEP', help=(
+        "Backup to backup/archivist-NAME-*.tar.zst on cron schedule and "
+        "keep KEEP most recent archives (0 keeps all)."))
+def daemon_command(schedules):
+    """ Run scheduled backups """
+
+    logging.basicConfig(format='%(name)s: %(message)s', level=logging.INFO)
+    try:
+        schedules = [Schedule(name, cron, keep) for name, cron, keep in schedules]
+    except ValueError as exc:
+        raise click.UsageError(str(exc))
+    daemon(schedules, backup)
 
 
 @click.group()
@@ -142,6 +317,9 @@ def main():
 
 main.command('backup')(backup_options())
 main.command('restore')(restore_options())
+main.command('verify')(verify_options())
+main.add_command(throttle_command)
+main.add_command(daemon_command)
 
 shortcut_backup = click.command('backup')(backup_options())
 shortcut_restore = click.command('restore')(restore_options())
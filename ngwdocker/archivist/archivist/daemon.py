@@ -0,0 +1,219 @@
+import io
+import os
+import re
+import json
+import fcntl
+import signal
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from glob import glob
+from time import time, sleep
+
+# Shared through backup volume like throttle control file
+HISTORY_FILE = 'backup/.archivist-history'
+
+ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+}
+
+# Schedule names are a part of archive names
+SCHEDULE_NAME = re.compile(r'^[a-z0-9_]+$')
+
+logger = logging.getLogger('archivist.daemon')
+
+
+class BackupLocked(RuntimeError):
+    pass
+
+
+@contextmanager
+def backup_lock(directory):
+    """ Exclusive lock of backup directory, it works across containers
+    sharing the same volume """
+
+    fd = open(os.path.join(directory, '.archivist.lock'), 'w')
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            raise BackupLocked("Another backup is running in %s" % directory)
+        yield
+    finally:
+        fd.close()
+
+
+def parse_field(value, lo, hi):
+    result = set()
+    for part in value.split(','):
+        rng, _, step = part.partition('/')
+        step = int(step) if step != '' else 1
+        if rng == '*':
+            start, end = lo, hi
+        elif '-' in rng:
+            start, end = (int(v) for v in rng.split('-', 1))
+        else:
+            start = int(rng)
+            end = hi if step > 1 else start
+        if not lo <= start <= end <= hi or step < 1:
+            raise ValueError("Invalid cron field: %s" % value)
+        result.update(range(start, end + 1, step))
+    return result
+
+
+class Cron(object):
+    """ Schedule in crontab format: minute, hour, day of month, month and
+    day of week. As in cron a day matches if either day of month or day of
+    week matches when both are restricted. """
+
+    def __init__(self, expr):
+        fields = ALIASES.get(expr, expr).split()
+        if len(fields) != 5:
+            raise ValueError("Invalid cron expression: %s" % expr)
+        self.expr = expr
+        self.minute = parse_field(fields[0], 0, 59)
+        self.hour = parse_field(fields[1], 0, 23)
+        self.dom = parse_field(fields[2], 1, 31)
+        self.month = parse_field(fields[3], 1, 12)
+        self.dow = set(d % 7 for d in parse_field(fields[4], 0, 7))
+        self.dom_any = fields[2] == '*'
+        self.dow_any = fields[4] == '*'
+
+    def match_day(self, dt):
+        dom = dt.day in self.dom
+        dow = dt.isoweekday() % 7 in self.dow
+        if self.dom_any or self.dow_any:
+            return dom and dow
+        return dom or dow
+
+    def next(self, after):
+        """ First matching minute after given datetime """
+
+        dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=5 * 366)
+        while dt < limit:
+            if dt.month not in self.month:
+                dt = (dt.replace(day=1) + timedelta(days=32)).replace(
+                    day=1, hour=0, minute=0)
+            elif not self.match_day(dt):
+                dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+            elif dt.hour not in self.hour:
+                dt = (dt + timedelta(hours=1)).replace(minute=0)
+            elif dt.minute not in self.minute:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError("Cron expression never matches: %s" % self.expr)
+
+
+class Schedule(object):
+
+    def __init__(self, name, cron, keep=0):
+        if not SCHEDULE_NAME.match(name):
+            raise ValueError("Invalid schedule name: %s" % name)
+        self.name = name
+        self.cron = Cron(cron)
+        self.keep = keep
+        self.next_run = None
+
+        # Glob also matches archives of schedules sharing name prefix and
+        # archives not made by daemon, so names are matched exactly.
+        self.regex = re.compile(
+            r'^archivist-%s-\d{8}-\d{6}\.tar\.zst$' % re.escape(name))
+
+    def archives(self):
+        return [
+            fn for fn in glob('backup/archivist-%s-*.tar.zst' % self.name)
+            if self.regex.match(os.path.basename(fn))]
+
+    def filename(self, now):
+        return 'backup/archivist-%s-%s' % (
+            self.name, now.strftime("%Y%m%d-%H%M%S.tar.zst"))
+
+    def retention(self):
+        """ Remove archives of this schedule except keep most recent ones
+        and return list of removed files """
+
+        if not self.keep:
+            return []
+        # Timestamp in file name sorts chronologically
+        expired = sorted(self.archives())[:-self.keep]
+        for fn in expired:
+            os.unlink(fn)
+        return expired
+
+
+def write_history(record):
+    with io.open(HISTORY_FILE, 'a') as fd:
+        fd.write(u'%s\n' % json.dumps(record, sort_keys=True))
+
+
+def run_schedule(schedule, backup):
+    started = datetime.utcnow()
+    start = time()
+    filename = schedule.filename(started)
+    record = dict(
+        schedule=schedule.name, started=started.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        filename=filename)
+
+    logger.info("Starting [%s] backup to %s", schedule.name, filename)
+    try:
+        backup(filename)
+        record.update(status='ok', size=os.path.getsize(filename))
+        record['removed'] = schedule.retention()
+        for fn in record['removed']:
+            logger.info("Removed expired archive %s", fn)
+    except BackupLocked as exc:
+        record.update(status='skipped', error=str(exc))
+        logger.warning("Backup [%s] skipped: %s", schedule.name, exc)
+    except Exception as exc:
+        record.update(status='failed', error=str(exc))
+        logger.exception("Backup [%s] failed", schedule.name)
+
+    record['duration'] = round(time() - start, 3)
+    logger.info(
+        "Backup [%s] %s in %.1fs", schedule.name,
+        record['status'], record['duration'])
+    write_history(record)
+    return record
+
+
+def daemon(schedules, backup):
+    """ Run backups on schedules until terminated. Schedules are processed
+    one at a time, so ticks missed while a backup is running are skipped. """
+
+    # Python ignores SIGTERM when running as PID 1 of a container
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+    if len(schedules) == 0:
+        logger.info("No schedules configured, idling")
+
+    # Schedules are in UTC like archive names
+    now = datetime.utcnow()
+    for s in schedules:
+        s.next_run = s.cron.next(now)
+        logger.info("Schedule [%s] %s, next run at %s", s.name, s.cron.expr, s.next_run)
+
+    while True:
+        now = datetime.utcnow()
+        due = [s for s in schedules if s.next_run <= now]
+        if len(due) == 0:
+            wakeup = min([s.next_run for s in schedules]) if schedules else None
+            delay = 60 if wakeup is None else (wakeup - now).total_seconds()
+            # Limit sleep time, so wall clock changes are noticed
+            sleep(min(max(delay, 0.1), 60))
+            continue
+
+        for s in due:
+            run_schedule(s, backup)
+
+        now = datetime.utcnow()
+        for s in schedules:
+            if s.next_run <= now:
+                s.next_run = s.cron.next(now)
+                logger.info("Next [%s] run at %s", s.name, s.next_run)
@@ -0,0 +1,164 @@
+import os
+import io
+import json
+import zlib
+import struct
+import hashlib
+import tarfile
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+# Manifest is appended to archive as zstd skippable frames which are ignored
+# by decompressor, so tar never sees them. The last frame has fixed size and
+# points to the frame with zlib compressed JSON manifest.
+FRAME_MANIFEST = 0x184D2A5A
+FRAME_FOOTER = 0x184D2A5B
+FRAME_HEADER = struct.Struct('<II')
+FOOTER_TAG = b'ARCVMNFT'
+FOOTER = struct.Struct('<8sQ')
+
+ALGORITHM = 'sha256'
+CHUNK_SIZE = 1024 * 1024
+
+
+def default_workers():
+    try:
+        from multiprocessing import cpu_count
+        return min(cpu_count(), 4)
+    except (ImportError, NotImplementedError):
+        return 2
+
+
+class CountingReader(object):
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.nbytes = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.nbytes += len(data)
+        return data
+
+
+class Hasher(object):
+    """ Read tar stream and hash regular file members in worker threads.
+    Members are distributed between workers round-robin and chunks of a
+    member are queued to the same worker, so they are hashed in order.
+    Result is a dict of member name to [size, digest] where digest is None
+    for anything except regular files. """
+
+    def __init__(self, workers=None):
+        self.workers = workers if workers else default_workers()
+        self.members = dict()
+        self.error = None
+
+    def _worker(self, queue):
+        hashes = dict()
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            name, chunk = item
+            if chunk is not None:
+                hashes.setdefault(name, hashlib.new(ALGORITHM)).update(chunk)
+            else:
+                digest = hashes.pop(name, None) or hashlib.new(ALGORITHM)
+                self.members[name][1] = digest.hexdigest()
+
+    def feed(self, fileobj):
+        """ Hash all members of tar stream. Errors are stored in error
+        attribute instead of raising and the stream is always read till the
+        end, so a writer on the other side of a pipe never blocks. """
+
+        queues = [Queue(maxsize=16) for i in range(self.workers)]
+        threads = [
+            threading.Thread(target=self._worker, args=(q, ))
+            for q in queues]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            archive = tarfile.open(fileobj=fileobj, mode='r|')
+            for idx, member in enumerate(archive):
+                self.members[member.name] = [member.size if member.isfile() else 0, None]
+                if not member.isfile():
+                    continue
+                queue = queues[idx % len(queues)]
+                data = archive.extractfile(member)
+                while True:
+                    chunk = data.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    queue.put((member.name, chunk))
+                queue.put((member.name, None))
+        except Exception as exc:
+            self.error = exc
+        finally:
+            for q in queues:
+                q.put(None)
+            for t in threads:
+                t.join()
+            while fileobj.read(CHUNK_SIZE):
+                pass
+
+
+def write_manifest(fd, members):
+    payload = zlib.compress(json.dumps(dict(
+        algorithm=ALGORITHM, members=members,
+    ), sort_keys=True).encode('utf-8'))
+    fd.write(FRAME_HEADER.pack(FRAME_MANIFEST, len(payload)))
+    fd.write(payload)
+    fd.write(FRAME_HEADER.pack(FRAME_FOOTER, FOOTER.size))
+    fd.write(FOOTER.pack(FOOTER_TAG, FRAME_HEADER.size + len(payload)))
+
+
+def read_manifest(filename):
+    """ Manifest members of archive or None if archive has no manifest """
+
+    tail = FRAME_HEADER.size + FOOTER.size
+    with io.open(filename, 'rb') as fd:
+        fd.seek(0, os.SEEK_END)
+        fsize = fd.tell()
+        if fsize < tail:
+            return None
+        fd.seek(fsize - tail)
+        magic, size = FRAME_HEADER.unpack(fd.read(FRAME_HEADER.size))
+        tag, msize = FOOTER.unpack(fd.read(FOOTER.size))
+        if magic != FRAME_FOOTER or size != FOOTER.size or tag != FOOTER_TAG:
+            return None
+
+        if msize > fsize - tail:
+            raise ValueError("Archive manifest is damaged")
+        fd.seek(fsize - tail - msize)
+        magic, size = FRAME_HEADER.unpack(fd.read(FRAME_HEADER.size))
+        if magic != FRAME_MANIFEST or size != msize - FRAME_HEADER.size:
+            raise ValueError("Archive manifest is damaged")
+        try:
+            manifest = json.loads(zlib.decompress(fd.read(size)).decode('utf-8'))
+        except (zlib.error, ValueError):
+            raise ValueError("Archive manifest is damaged")
+
+    if manifest['algorithm'] != ALGORITHM:
+        raise ValueError("Unsupported manifest algorithm: %s" % manifest['algorithm'])
+    return manifest['members']
+
+
+def compare(manifest, members):
+    """ Compare hashed members with manifest and return list of (name,
+    problem) tuples for damaged, missing and unexpected members """
+
+    result = list()
+    for name in sorted(set(manifest) | set(members)):
+        if name not in members:
+            result.append((name, 'missing'))
+        elif name not in manifest:
+            result.append((name, 'unexpected'))
+        elif list(manifest[name]) != list(members[name]):
+            result.append((name, 'damaged'))
+    return result
@@ -0,0 +1,225 @@
+import os
+import io
+import logging
+import subprocess
+from time import time, sleep
+
+MB = 1024 * 1024
+
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# Shared through backup volume, so limits can be changed from another
+# container: docker-compose run --rm archivist archivist throttle ...
+CONTROL_FILE = 'backup/.archivist-throttle'
+
+logger = logging.getLogger('archivist.throttle')
+
+
+def parse_ionice(value):
+    """ Parse I/O scheduling class in form CLASS[:LEVEL] where class is
+    realtime, best-effort, idle or its number. Returns (class, level) tuple
+    where level may be None. """
+
+    cls, _, level = str(value).partition(':')
+    cls = IONICE_CLASSES.get(cls, cls)
+    try:
+        cls = int(cls)
+        level = int(level) if level != '' else None
+    except ValueError:
+        raise ValueError("Invalid I/O scheduling class: %s" % value)
+    if cls not in (1, 2, 3) or (level is not None and not 0 <= level <= 7):
+        raise ValueError("Invalid I/O scheduling class: %s" % value)
+    return (cls, level)
+
+
+def format_rate(nbytes, seconds):
+    return '%.1f MB in %.1fs (%.1f MB/s)' % (
+        float(nbytes) / MB, seconds, float(nbytes) / MB / max(seconds, 0.001))
+
+
+class Throttle(object):
+    """ Limits of archivist subprocesses: bandwidth in MB/s of data streamed
+    between them, CPU niceness and I/O scheduling class. While data is
+    streamed the control file is checked every second and changed limits are
+    applied to running subprocesses. """
+
+    check_interval = 1.0
+    bufsize = 256 * 1024
+
+    def __init__(self, bwlimit=None, nice=None, ionice=None, control=CONTROL_FILE):
+        self.defaults = dict(bwlimit=bwlimit, nice=nice, ionice=ionice)
+        self.control = control
+        self.control_mtime = None
+        self.pids = list()
+        self.update(self.defaults)
+
+    @classmethod
+    def from_env(cls, bwlimit=None, nice=None, ionice=None):
+        """ Limits from arguments with defaults from ARCHIVIST_BWLIMIT,
+        ARCHIVIST_NICE and ARCHIVIST_IONICE environment variables """
+
+        env = os.environ
+        if bwlimit is None and env.get('ARCHIVIST_BWLIMIT'):
+            bwlimit = float(env['ARCHIVIST_BWLIMIT'])
+        if nice is None and env.get('ARCHIVIST_NICE'):
+            nice = int(env['ARCHIVIST_NICE'])
+        if ionice is None and env.get('ARCHIVIST_IONICE'):
+            ionice = env['ARCHIVIST_IONICE']
+        return cls(bwlimit=bwlimit, nice=nice, ionice=ionice)
+
+    def update(self, limits):
+        self.bwlimit = float(limits['bwlimit']) if limits['bwlimit'] else None
+        self.nice = int(limits['nice']) if limits['nice'] is not None else None
+        self.ionice = parse_ionice(limits['ionice']) \
+            if limits['ionice'] is not None else None
+
+    def describe(self):
+        return 'bwlimit=%s nice=%s ionice=%s' % (
+            '%g MB/s' % self.bwlimit if self.bwlimit else 'none',
+            self.nice if self.nice is not None else 'none',
+            ':'.join(str(v) for v in self.ionice if v is not None)
+            if self.ionice is not None else 'none')
+
+    def prefix(self):
+        """ Command prefix which starts a subprocess with current limits.
+        Both ionice and nice exec the command, so it keeps the same pid. """
+
+        result = list()
+        if self.ionice is not None:
+            cls, level = self.ionice
+            result.extend(('ionice', '-c', str(cls)))
+            if level is not None:
+                result.extend(('-n', str(level)))
+        if self.nice is not None:
+            result.extend(('nice', '-n', str(self.nice)))
+        return result
+
+    def reload(self):
+        """ Re-read the control file and apply changed limits to running
+        subprocesses. Returns True if limits have changed. """
+
+        try:
+            mtime = os.stat(self.control).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.control_mtime:
+            return False
+        self.control_mtime = mtime
+
+        limits = dict(self.defaults)
+        if mtime is not None:
+            limits.update(read_control(self.control))
+
+        previous = (self.bwlimit, self.nice, self.ionice)
+        try:
+            self.update(limits)
+        except ValueError as exc:
+            logger.error("Invalid throttle control file: %s", exc)
+            return False
+        if (self.bwlimit, self.nice, self.ionice) == previous:
+            return False
+
+        logger.info("Throttle changed: %s", self.describe())
+        with io.open(os.devnull, 'wb') as devnull:
+            for pid in self.pids:
+                cmds = list()
+                if self.nice is not None:
+                    cmds.append(['renice', '-n', str(self.nice), '-p', str(pid)])
+                if self.ionice is not None:
+                    cls, level = self.ionice
+                    cmds.append(
+                        ['ionice', '-c', str(cls)]
+                        + (['-n', str(level)] if level is not None else [])
+                        + ['-p', str(pid)])
+                for cmd in cmds:
+                    # Unprivileged user can't decrease niceness
+                    if subprocess.call(cmd, stdout=devnull, stderr=devnull) != 0:
+                        logger.warning("Failed to apply limits: %s", ' '.join(cmd))
+        return True
+
+    def pump(self, src, dst, tee=None):
+        """ Copy data between file objects not faster than bandwidth limit
+        and return number of bytes copied. Data is also passed to optional
+        tee callable. """
+
+        nbytes = 0
+        window_start = last_check = time()
+        window_bytes = 0
+        while True:
+            buf = src.read(self.bufsize)
+            if not buf:
+                break
+            dst.write(buf)
+            if tee is not None:
+                tee(buf)
+            nbytes += len(buf)
+            window_bytes += len(buf)
+
+            now = time()
+            if now - last_check >= self.check_interval:
+                last_check = now
+                if self.reload():
+                    window_start, window_bytes = now, 0
+
+            if self.bwlimit:
+                delay = float(window_bytes) / (self.bwlimit * MB) - (now - window_start)
+                if delay > 0:
+                    sleep(delay)
+
+        return nbytes
+
+    def pipe(self, producer, consumer, stdout=None, check=True, tee=None):
+        """ Run producer and consumer commands with data streamed between
+        them through pump(). Returns number of bytes, elapsed time and
+        consumer return code which is checked only if check is True. """
+
+        self.reload()
+        start = time()
+        prod = subprocess.Popen(
+            self.prefix() + producer, stdout=subprocess.PIPE, close_fds=True)
+        cons = subprocess.Popen(
+            self.prefix() + consumer, stdin=subprocess.PIPE, stdout=stdout,
+            close_fds=True)
+        self.pids = [prod.pid, cons.pid]
+
+        try:
+            try:
+                nbytes = self.pump(prod.stdout, cons.stdin, tee)
+            finally:
+                prod.stdout.close()
+                cons.stdin.close()
+        except BaseException:
+            for proc in (prod, cons):
+                if proc.poll() is None:
+                    proc.kill()
+            raise
+        finally:
+            for proc in (prod, cons):
+                proc.wait()
+            self.pids = list()
+
+        if prod.returncode != 0:
+            raise subprocess.CalledProcessError(prod.returncode, producer)
+        if check and cons.returncode != 0:
+            raise subprocess.CalledProcessError(cons.returncode, consumer)
+
+        return nbytes, time() - start, cons.returncode
+
+
+def read_control(filename):
+    result = dict()
+    with io.open(filename, 'r') as fd:
+        for line in fd:
+            key, sep, value = line.strip().partition('=')
+            if sep == '' or key not in ('bwlimit', 'nice', 'ionice'):
+                continue
+            result[key] = value if value not in ('', 'none') else None
+    return result
+
+
+def write_control(filename, limits):
+    with io.open(filename, 'w') as fd:
+        for key in ('bwlimit', 'nice', 'ionice'):
+            if key in limits:
+                value = limits[key]
+                fd.write(u'%s=%s\n' % (key, 'none' if value is None else value))
@@ -1,3 +1,4 @@
+import re
 from collections import OrderedDict
 from shutil import copytree
 from pathlib import Path
@@ -6,12 +7,13 @@ from packaging.version import Version
 from loguru import logger
 
 from ngwdocker.package import PackageBase
-from ngwdocker.image import Service
+from ngwdocker.image import Service, home_ids
 from ngwdocker.util import pwgen
 
 from .app import AppImage
 from .postgres import PostgresImage
 from .archivist import ArchivistImage
+from .prometheus import PrometheusImage
 
 
 class Package(PackageBase):
@@ -21,22 +23,27 @@ class Package(PackageBase):
         cap_secret = pkg_nextgisweb.version is not None and not (
             pkg_nextgisweb.version < Version('3.2.0.dev0'))
 
-        def add_data(svc, svc_name=None):
+        def add_data(svc, svc_name=None, mount_name=None):
             if svc_name is None:
                 svc_name = svc.name
+            if mount_name is None:
+                mount_name = svc_name
             vol_name = 'data_{}'.format(svc_name)
-            svc.add_volume(vol_name, '/opt/ngw/data/{}'.format(svc_name))
+            svc.add_volume(vol_name, '/opt/ngw/data/{}'.format(mount_name))
             if vol_name not in self.context.volumes:
                 self.context.volumes[vol_name] = OrderedDict()
         
-        def add_config(svc, svc_name=None):
+        def add_config(svc, svc_name=None, mount_name=None):
             if svc_name is None:
                 svc_name = svc.name
-            mpoint = '/opt/ngw/config/{}'.format(svc_name)
+            if mount_name is None:
+                mount_name = svc_name
+            mpoint = '/opt/ngw/config/{}'.format(mount_name)
             
             if self.context.is_development():
                 bind_pth = self.context.path / 'config' / svc_name
-                bind_pth.mkdir(parents=True, exist_ok=True)
+                if not self.context.plan:
+                    bind_pth.mkdir(parents=True, exist_ok=True)
                 svc.add_bind('./' + str(bind_pth), mpoint)
             else:
                 vol_name = 'config_{}'.format(svc_name)
@@ -44,20 +51,34 @@ class Package(PackageBase):
                 if vol_name not in self.context.volumes:
                     self.context.volumes[vol_name] = OrderedDict()
 
-        def add_secret(svc):
+        def add_secret(svc, iname=None):
+            # Instance gets own secret directory with the same layout, so it
+            # can't read secrets of postgres and other instances.
             if self.context.is_development():
                 secret_pth = self.context.path / 'secret'
-                secret_pth.mkdir(exist_ok=True)
+                if iname is not None:
+                    secret_pth = secret_pth / iname
+                if not self.context.plan:
+                    secret_pth.mkdir(parents=True, exist_ok=True)
                 svc.add_bind('./' + str(secret_pth), '/opt/ngw/secret')
             else:
-                svc.add_volume('secret', '/opt/ngw/secret')
-                if 'secret' not in self.context.volumes:
-                    self.context.volumes['secret'] = OrderedDict()
+                vol_name = 'secret' if iname is None else 'secret_{}'.format(iname)
+                svc.add_volume(vol_name, '/opt/ngw/secret')
+                if vol_name not in self.context.volumes:
+                    self.context.volumes[vol_name] = OrderedDict()
+
+        def add_instance_secrets(svc):
+            # Instance secret directories are subdirectories of secret
+            # directory in development mode, so only volumes are mounted.
+            if self.context.is_development():
+                return
+            for iname in self.context.instances:
+                svc.add_volume('secret_{}'.format(iname), '/opt/ngw/secret/{}'.format(iname))
 
         def add_backup(svc):
             if self.context.is_development():
                 pth_backup = self.context.path / 'backup'
-                if not pth_backup.exists():
+                if not pth_backup.exists() and not self.context.plan:
                     pth_backup.mkdir()
                 svc.add_bind('./' + str(pth_backup), '/opt/ngw/backup')
             else:
@@ -81,51 +102,133 @@ class Package(PackageBase):
         app_img = AppImage()
         self.context.add_image(app_img)
 
-        app_svc = Service('app', app_img)
-        app_svc.restart = True
-        add_data(app_svc)
-        add_config(app_svc)
-        add_secret(app_svc)
-
-        if self.context.default_instance:
-            if "DATABASE_PASSWORD" in self.context.envfile:
-                app_svc.environment['NEXTGISWEB_CORE__DATABASE__PASSWORD'] = '${DATABASE_PASSWORD}'
+        instances = self.context.instances
+        if len(instances) > 0 and not cap_secret:
+            raise RuntimeError(
+                "Multiple instances require nextgisweb 3.2.0 or higher!")
+        elif len(instances) == 0:
+            instances = OrderedDict([(None, dict())])
+
+        # Instances without explicit port get next free port after 8080
+        ports_used = set(i['port'] for i in instances.values() if 'port' in i)
+        port_next = 8080
+
+        app_svcs = list()
+        for iname, isettings in instances.items():
+            app_svc = Service('app' if iname is None else 'app_{}'.format(iname), app_img)
+            app_svc.restart = True
+            add_data(app_svc, mount_name='app')
+            add_config(app_svc, mount_name='app')
+            add_secret(app_svc, iname)
+
+            if iname is not None:
+                # Each instance has own database in shared postgres, its
+                # password is written to secret/postgres of the instance.
+                app_svc.environment['NEXTGISWEB_CORE__DATABASE__NAME'] = iname
+                app_svc.environment['NEXTGISWEB_CORE__DATABASE__USER'] = iname
+
+                for k in ('memory', 'cpus'):
+                    if k in isettings:
+                        app_svc.limits[k] = str(isettings[k])
+
+            elif self.context.default_instance:
+                if "DATABASE_PASSWORD" in self.context.envfile:
+                    app_svc.environment['NEXTGISWEB_CORE__DATABASE__PASSWORD'] = \
+                        '${DATABASE_PASSWORD}'
+
+                if "PYRAMID_SECRET" in self.context.envfile:
+                    app_svc.environment['NEXTGISWEB_PYRAMID__SECRET'] = '${PYRAMID_SECRET}'
 
-            if "PYRAMID_SECRET" in self.context.envfile:
-                app_svc.environment['NEXTGISWEB_PYRAMID__SECRET'] = '${PYRAMID_SECRET}'
-
-        if self.context.is_development():
-            pth_work = self.context.path / 'work'
-            if not pth_work.exists():
-                pth_work.mkdir()
+            if self.context.is_development():
+                pth_work = self.context.path / 'work'
+                if not pth_work.exists() and not self.context.plan:
+                    pth_work.mkdir()
 
-            app_svc.add_bind('./' + str(pth_work), '/opt/ngw/work')
+                app_svc.add_bind('./' + str(pth_work), '/opt/ngw/work')
 
-        add_backup(app_svc)
+            add_backup(app_svc)
 
-        if self.context.is_development():
-            app_svc.add_bind('./package', '/opt/ngw/package')
+            if self.context.is_development():
+                app_svc.add_bind('./package', '/opt/ngw/package')
 
-        if self.context.default_instance:
-            app_svc.ports.append('8080:8080')
+            if self.context.default_instance:
+                port = isettings.get('port')
+                if port is None:
+                    while port_next in ports_used:
+                        port_next += 1
+                    port = port_next
+                    ports_used.add(port)
+                app_svc.ports.append('{}:8080'.format(port))
 
-        self.context.add_service(app_svc)
+            self.context.add_service(app_svc)
+            app_svcs.append(app_svc)
 
         postgres_img = PostgresImage()
         self.context.add_image(postgres_img)
 
+        postgres_template_st = self.settings.get('postgres_template', dict())
+        if postgres_template_st.get('enabled', False) is True:
+            postgres_img.cluster_template = True
+
         postgres_svc = Service('postgres', postgres_img)
         postgres_svc.restart = True
         add_data(postgres_svc)
         add_config(postgres_svc)
         add_secret(postgres_svc)
+        add_instance_secrets(postgres_svc)
 
         self.context.add_service(postgres_svc)
-        app_svc.depends_on.append(postgres_svc)
+        for app_svc in app_svcs:
+            app_svc.depends_on.append(postgres_svc)
+
+        if len(self.context.instances) > 0:
+            postgres_svc.environment['NGWDOCKER_POSTGRES_DATABASES'] = \
+                ' '.join(self.context.instances.keys())
+
+        postgres_wal_st = self.settings.get('postgres_wal', dict())
+        postgres_wal = postgres_wal_st.get('enabled', False) is True
+        if postgres_wal:
+            postgres_svc.add_volume('wal_postgres', '/opt/ngw/wal/postgres')
+            self.context.volumes['wal_postgres'] = OrderedDict()
+            postgres_svc.environment['NGWDOCKER_POSTGRES_WALDIR'] = '/opt/ngw/wal/postgres'
+
+        postgres_temp_st = self.settings.get('postgres_temp', dict())
+        if postgres_temp_st.get('enabled', False) is True:
+            if postgres_temp_st.get('tmpfs', False) is True:
+                postgres_svc.add_tmpfs('/opt/ngw/temp/postgres', postgres_temp_st.get('size'))
+            else:
+                postgres_svc.add_volume('temp_postgres', '/opt/ngw/temp/postgres')
+                self.context.volumes['temp_postgres'] = OrderedDict()
+            postgres_svc.environment['NGWDOCKER_POSTGRES_TEMPDIR'] = '/opt/ngw/temp/postgres'
 
         if self.context.default_instance and "DATABASE_PASSWORD" in self.context.envfile:
             postgres_svc.environment['POSTGRES_PASSWORD'] = '${DATABASE_PASSWORD}'
 
+        replica_st = self.settings.get('replica', dict())
+        if replica_st.get('enabled', False) is True:
+            postgres_svc.environment['NGWDOCKER_POSTGRES_REPLICATION'] = 'yes'
+
+            replica_hosts = list()
+            for idx in range(1, replica_st.get('count', 1) + 1):
+                replica_svc = Service('postgres_replica_{}'.format(idx), postgres_img)
+                replica_svc.restart = True
+
+                # Replica has own data volume but the same layout as primary
+                vol_name = 'data_{}'.format(replica_svc.name)
+                replica_svc.add_volume(vol_name, '/opt/ngw/data/postgres')
+                self.context.volumes[vol_name] = OrderedDict()
+                add_config(replica_svc, 'postgres')
+                add_secret(replica_svc)
+
+                replica_svc.environment['NGWDOCKER_POSTGRES_INITDB'] = 'no'
+                replica_svc.environment['NGWDOCKER_POSTGRES_REPLICA_OF'] = postgres_svc.name
+
+                self.context.add_service(replica_svc)
+                replica_svc.depends_on.append(postgres_svc)
+                replica_hosts.append(replica_svc.name)
+
+            app_img.config_set('core', 'database.replica.host', ','.join(replica_hosts))
+
         archivist_img = ArchivistImage()
         self.context.add_image(archivist_img)
 
@@ -133,11 +236,31 @@ class Package(PackageBase):
         archivist_svc.restart = True
         self.context.add_service(archivist_svc)
 
-        add_data(archivist_svc, 'app')
+        archivist_st = self.settings.get('archivist', dict())
+        throttle_st = archivist_st.get('throttle', dict())
+        for k in ('bwlimit', 'nice', 'ionice'):
+            if k in throttle_st:
+                archivist_svc.environment['ARCHIVIST_{}'.format(k.upper())] = \
+                    str(throttle_st[k])
+
+        # Scheduled backups instead of idle shell
+        archivist_svc.command = ['archivist', 'daemon']
+        for sname, schedule in archivist_st.get('schedule', dict()).items():
+            if not re.match(r'^[a-z0-9_]+$', sname):
+                raise RuntimeError("Invalid archivist schedule name [{}]!".format(sname))
+            archivist_svc.command.extend((
+                '--schedule', sname, schedule['cron'], str(schedule.get('keep', 0))))
+
+        for app_svc in app_svcs:
+            add_data(archivist_svc, app_svc.name)
         add_data(archivist_svc, 'postgres')
-        add_config(archivist_svc, 'app')
+        if postgres_wal:
+            archivist_svc.add_volume('wal_postgres', '/opt/ngw/wal/postgres')
+        for app_svc in app_svcs:
+            add_config(archivist_svc, app_svc.name)
         add_config(archivist_svc, 'postgres')
         add_secret(archivist_svc)
+        add_instance_secrets(archivist_svc)
 
         add_backup(archivist_svc)
 
@@ -168,7 +291,8 @@ class Package(PackageBase):
             elasticsearch_svc.restart = True
 
             self.context.add_service(elasticsearch_svc)
-            app_svc.depends_on.append(elasticsearch_svc)
+            for app_svc in app_svcs:
+                app_svc.depends_on.append(elasticsearch_svc)
 
             elasticsearch_svc.environment['cluster.name'] = 'ngwdocker'
             elasticsearch_svc.environment['discovery.type'] = 'single-node'
@@ -193,3 +317,58 @@ class Package(PackageBase):
             kibana_svc.environment['ELASTICSEARCH_HOSTS'] = 'http://elasticsearch:9200'
 
             kibana_svc.ports.append('8561:5601')
+
+        metrics_st = self.settings.get('metrics', dict())
+        if metrics_st.get('enabled', False) is True:
+            prometheus_img = PrometheusImage()
+            prometheus_img.add_target('prometheus', 'localhost:9090')
+            exporters = list()
+
+            # Stats server is available only for uWSGI, so there is
+            # nothing to export with pserve in development mode.
+            for app_svc in (app_svcs if self.context.is_production() else ()):
+                app_svc.environment['UWSGI_STATS'] = '0.0.0.0:1717'
+
+                uwsgi_exporter_img = 'timonwong/uwsgi-exporter:v1.3.0'
+                uwsgi_exporter_svc = Service(
+                    app_svc.name.replace('app', 'uwsgi_exporter', 1),
+                    uwsgi_exporter_img)
+                uwsgi_exporter_svc.restart = True
+                uwsgi_exporter_svc.command = [
+                    '--stats.uri=http://{}:1717'.format(app_svc.name)]
+
+                self.context.add_service(uwsgi_exporter_svc)
+                uwsgi_exporter_svc.depends_on.append(app_svc)
+                exporters.append(uwsgi_exporter_svc)
+                prometheus_img.add_target('uwsgi', '{}:9117'.format(uwsgi_exporter_svc.name))
+
+            postgres_exporter_img = 'quay.io/prometheuscommunity/postgres-exporter:v0.15.0'
+            postgres_exporter_svc = Service('postgres_exporter', postgres_exporter_img)
+            postgres_exporter_svc.restart = True
+
+            # Secret file is readable only by container user
+            postgres_exporter_svc.user = '{}:{}'.format(*home_ids(self.context))
+            add_secret(postgres_exporter_svc)
+
+            postgres_exporter_svc.environment['DATA_SOURCE_URI'] = \
+                'postgres:5432/nextgisweb?sslmode=disable'
+            postgres_exporter_svc.environment['DATA_SOURCE_USER'] = 'nextgisweb'
+            postgres_exporter_svc.environment['DATA_SOURCE_PASS_FILE'] = '/opt/ngw/secret/postgres'
+
+            self.context.add_service(postgres_exporter_svc)
+            postgres_exporter_svc.depends_on.append(postgres_svc)
+            exporters.append(postgres_exporter_svc)
+            prometheus_img.add_target('postgres', 'postgres_exporter:9187')
+
+            if metrics_st.get('prometheus', True) is True:
+                self.context.add_image(prometheus_img)
+
+                prometheus_svc = Service('prometheus', prometheus_img)
+                prometheus_svc.restart = True
+                self.context.add_service(prometheus_svc)
+                prometheus_svc.depends_on.extend(exporters)
+
+                self.context.volumes['prometheus'] = {}
+                prometheus_svc.add_volume('prometheus', '/prometheus')
+
+                prometheus_svc.ports.append('8990:9090')
@@ -1,13 +1,38 @@
 import io
-import tarfile
+import os
+import logging
 import configparser
 from itertools import chain
 from pathlib import Path
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 from collections import OrderedDict
+from hashlib import sha256
 
 from ngwdocker.image import Image, ImageEvent, AptEvent, HomeEvent, VirtualenvEvent
-from ngwdocker.util import copyfiles, git_ls_files
+from ngwdocker.util import copyfiles, write_tar, git_ls_files
+
+# Paths which compileall can't compile: test fixtures with intentionally
+# broken or another Python version syntax and async modules of jinja2
+# which are Python 3 only.
+COMPILEALL_EXCLUDE = r'/node_modules/|/tests?/|/jinja2/async[a-z]*\.py$'
+
+
+def po_digest(path):
+    """ Digest of translation catalogs (.po files) of package or None if
+    there are no catalogs. """
+    digest = sha256()
+    found = False
+    for root, dirs, files in sorted(os.walk(str(path))):
+        dirs.sort()
+        for fn in sorted(files):
+            if not fn.endswith('.po'):
+                continue
+            found = True
+            fp = Path(root) / fn
+            digest.update(str(fp.relative_to(path)).encode('utf-8') + b'\0')
+            with io.open(fp, 'rb') as fd:
+                digest.update(fd.read())
+    return digest.hexdigest() if found else None
 
 
 class AppImage(Image):
@@ -41,6 +66,10 @@ class AppImage(Image):
         super().__init__()
         self.default_config_sections = OrderedDict()
 
+    @property
+    def slim(self):
+        return self.context.is_production() and self.package.settings.get('slim', False)
+
     def configurator(self):
         super().configurator()
 
@@ -48,24 +77,38 @@ class AppImage(Image):
         apt.add_key('https://nextgis.com/key/68514A1DCF0CF9F7.asc')
         apt.add_repository('ppa:nextgis/ppa')
 
-        apt.package('git', 'mc', 'build-essential', 'libssl-dev')
-        apt.package(*(
-            ('python3', 'python3-dev', 'python3-venv') if self.context.python3
-            else ('python', 'python-dev', 'virtualenv', 'python-virtualenv')))
+        apt.build_package('git', 'mc', 'build-essential', 'libssl-dev')
+        if self.context.python3:
+            apt.package('python3')
+            apt.build_package('python3-dev', 'python3-venv')
+        else:
+            apt.package('python')
+            apt.build_package('python-dev', 'virtualenv', 'python-virtualenv')
 
         apt.package(
+            'gdal-bin',
+            'postgresql-client')
+
+        apt.build_package(
             'libgdal-dev',
             'libgeos-dev',
-            'gdal-bin',
             'g++',
             'libxml2-dev',
             'libxslt1-dev',
             'zlib1g-dev',
             'libjpeg-turbo8-dev',
             'nodejs',
-            'postgresql-client',
             'libmagic-dev')
 
+        apt.runtime_package(
+            'libssl1.1',
+            'libgeos-c1v5',
+            'libxml2',
+            'libxslt1.1',
+            'zlib1g',
+            'libjpeg-turbo8',
+            'libmagic1')
+
         apt.notify().render()
 
         home = self.on_home(self)
@@ -75,6 +118,7 @@ class AppImage(Image):
         home.notify().render()
 
         python_package = list()
+        i18n_package = list()
 
         virtualenv = self.on_virtualenv(self, '$NGWROOT/env').notify()
         virtualenv.requirement('uwsgi')
@@ -104,15 +148,62 @@ class AppImage(Image):
             else:
                 pkg_files = git_ls_files(package.path)
 
-            copyfiles(pkg_files, pth_package / pname, package.path)
+            with self.context.profiler.phase('copyfiles'):
+                copyfiles(pkg_files, pth_package / pname, package.path)
             virtualenv.package(package)
 
             if self.context.is_production():
-                virtualenv.after_install(
-                    '$NGWROOT/env/bin/nextgisweb-i18n -p {} compile'.format(pname))
+                po_hash = po_digest(pth_package / pname)
+                if po_hash is not None:
+                    i18n_package.append('{}:{}'.format(pname, po_hash[:16]))
+
+        # Modules from $NGWROOT/lib are used in generated logging.ini
+        virtualenv.after_install(
+            "echo $NGWROOT/lib > $($NGWROOT/env/bin/python -c "
+            "'import distutils.sysconfig as sc; print(sc.get_python_lib())')/ngwdocker.pth")
 
         virtualenv.notify().render()
 
+        if len(i18n_package) > 0:
+            # Compile catalogs of all packages concurrently in a separate
+            # layer, compiled files can be reused from BuildKit cache.
+            mounts = ()
+            i18n_cmd = 'bash $NGWROOT/bin/i18n-compile $(nproc) ' + ' '.join(i18n_package)
+            if self.package.settings.get('i18n_cache', False):
+                mounts = ('type=cache,target=/var/cache/ngw-i18n,uid={},gid={}'.format(
+                    home.uid, home.gid), )
+                i18n_cmd = 'I18N_CACHE=/var/cache/ngw-i18n ' + i18n_cmd
+
+            bin_src = Path(__file__).parent / 'image' / 'app' / 'bin'
+            self.copy(bin_src / 'i18n-compile', '$NGWROOT/bin/i18n-compile',
+                      chown='$NGWUSER:$NGWUSER')
+            self.run([i18n_cmd, ], sep=True, mounts=mounts)
+
+        if self.context.is_production():
+            # Precompile bytecode so uWSGI workers don't compile sources on
+            # each start. Known uncompilable paths are excluded, so any other
+            # failure (broken virtualenv for example) fails the build.
+            self.run([
+                '$NGWROOT/env/bin/python -m compileall -q {}'.format(
+                    '-j 0 ' if self.context.python3 else '')
+                + "-x '{}' $NGWROOT/env $NGWROOT/package".format(
+                    COMPILEALL_EXCLUDE),
+            ], sep=True)
+
+        if self.slim:
+            # Runtime stage: the same home layout without compilers and
+            # headers, virtualenv and packages are copied from build stage.
+            self.stage()
+            apt.render(runtime=True)
+            home.render()
+            self.copy_from('build', '$NGWROOT', '$NGWROOT', chown='$NGWUSER:$NGWUSER')
+            self.run([
+                "MISSING=$(find $NGWROOT/env -name '*.so*' -type f -exec ldd {} + "
+                "2> /dev/null | grep 'not found' | sort -u)",
+                'if [ -n "$MISSING" ]; then echo "Missing shared libraries: $MISSING" '
+                '> /dev/stderr; exit 1; fi',
+            ], sep=True)
+
         if self.context.is_development():
             self.config_set('core', 'debug', 'true')
 
@@ -142,9 +233,23 @@ class AppImage(Image):
             # Config directory template
             config_path = tmp_path / 'build' / 'config'
             config_path.mkdir(parents=True)
-            with tarfile.open(config_path / 'app.tar.gz', 'w:gz') as config_tar:
-                config_src = Path(__file__).parent / 'image' / 'app' / 'config' / 'app'
-                config_tar.add(config_src, 'app')
+            config_src = Path(__file__).parent / 'image' / 'app' / 'config' / 'app'
+            config_items = [(config_src, 'app'), ]
+
+            logging_obj = self.logging_config()
+            if logging_obj is not None:
+                logging_file = tmp_path / 'logging.ini'
+                with io.open(logging_file, 'w') as fd:
+                    logging_obj.write(fd)
+                config_items.append((logging_file, 'app/logging.ini'))
+
+            write_tar(config_path / 'app.tar.gz', config_items)
+            if logging_obj is not None:
+                logging_file.unlink()
+
+            # Python modules referenced from logging.ini
+            lib_src = Path(__file__).parent / 'image' / 'app' / 'lib'
+            copyfiles([lib_src, ], tmp_path / 'lib', lib_src)
 
             # Default config
             config_file = tmp_path / 'build' / 'config' / 'app' / 'config.ini'
@@ -158,6 +263,12 @@ class AppImage(Image):
 
             self.copy(tmp_path, '$NGWROOT', chown='$NGWUSER:$NGWUSER')
 
+        if self.context.is_production() and self.package.settings.get('importtime', False):
+            self.run([
+                '$NGWROOT/env/bin/python $NGWROOT/bin/importtime-report '
+                '$NGWROOT/build/importtime ' + ' '.join(python_package),
+            ], sep=True)
+
         self.environment['NGWDOCKER_PACKAGES'] = ' '.join(python_package)
 
         if self.context.default_instance:
@@ -175,15 +286,59 @@ class AppImage(Image):
 
         self.volume.extend(('$NGWROOT/data', '$NGWROOT/config', '$NGWROOT/backup'))
         self.entrypoint = ['{}/bin/docker-entrypoint'.format(home.home), ]
+        self.set_healthcheck(['{}/bin/healthcheck'.format(home.home), ], start_period='120s')
 
         if self.context.is_production():
             self.command = ['uwsgi-production', ]
         elif self.context.is_development():
-            self.command = ['pserve-development', ]
+            reloader = self.package.settings.get('reloader', dict())
+            if reloader.get('enabled', False):
+                self.command = ['pserve-inotify', '/opt/ngw/config/app/pserve.ini']
+                self.environment['NGWDOCKER_RELOAD_EXCLUDE'] = ':'.join(reloader.get(
+                    'exclude', ('node_modules', '.git', '.hg', '__pycache__', '*.egg-info')))
+                self.environment['NGWDOCKER_RELOAD_DEBOUNCE'] = str(reloader.get('debounce', 0.5))
+            else:
+                self.command = ['pserve-development', ]
 
         on_finish = self.on_finish(self)
         on_finish.notify()
 
+    def logging_config(self):
+        """ Production logging config with non-blocking handler or None to
+        use verbose logging.ini as is. """
+        if not self.context.is_production():
+            return None
+
+        settings = self.package.settings.get('logging', dict())
+        level = str(settings.get('level', 'WARNING')).upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise RuntimeError(
+                "Invalid logging level [{}] in ngwdocker settings!".format(level))
+        ngw_level = level if logging.getLevelName(level) < logging.INFO else 'INFO'
+
+        config = configparser.ConfigParser(interpolation=None)
+        config['loggers'] = OrderedDict(keys='root, nextgisweb')
+        config['handlers'] = OrderedDict(keys='queue')
+        config['formatters'] = OrderedDict(keys='formatter')
+
+        config['logger_root'] = OrderedDict(level=level, handlers='queue')
+        config['logger_nextgisweb'] = OrderedDict(
+            level=ngw_level, handlers='', qualname='nextgisweb')
+
+        config['handler_queue'] = OrderedDict((
+            ('class', 'ngwdocker_logging.QueueStreamHandler'),
+            ('formatter', 'formatter'),
+            ('args', '()')))
+
+        if settings.get('json', False):
+            config['formatter_formatter'] = OrderedDict((
+                ('class', 'ngwdocker_logging.JsonFormatter'), ))
+        else:
+            config['formatter_formatter'] = OrderedDict(
+                format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+
+        return config
+
     def config_set(self, component, option, value=None):
         section = self.default_config_sections.get(component)
         if section is None:
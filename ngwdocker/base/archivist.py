@@ -30,8 +30,15 @@ class ArchivistImage(Image):
         home = self.on_home(self)
         home.directory('bin', 'backup')
         home.directory('data', 'data/app', 'data/postgres')
+        home.directory('wal', 'wal/postgres')
         home.directory('config', 'config/app', 'config/postgres')
         home.directory('secret')
+        # Mount points of instance volumes have to exist in image, otherwise
+        # docker creates them owned by root.
+        for iname in self.context.instances:
+            home.directory(
+                'data/app_{}'.format(iname), 'config/app_{}'.format(iname),
+                'secret/{}'.format(iname))
         home.notify().render()
 
         venv = self.on_virtualenv(self, "$NGWROOT/env")
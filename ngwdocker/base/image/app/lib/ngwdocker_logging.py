@@ -0,0 +1,77 @@
+""" Logging handlers and formatters for production logging.ini """
+
+import sys
+import json
+import atexit
+import logging
+
+try:
+    import queue
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    # Python 2
+    QueueHandler = None
+
+
+class JsonFormatter(logging.Formatter):
+    """ Format record as one line JSON object """
+
+    def format(self, record):
+        data = dict(
+            time=self.formatTime(record, self.datefmt),
+            level=record.levelname,
+            logger=record.name,
+            message=record.getMessage())
+
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc_info'] = record.exc_text
+
+        return json.dumps(data)
+
+
+if QueueHandler is None:
+
+    class QueueStreamHandler(logging.StreamHandler):
+        """ Synchronous fallback for Python 2 """
+
+else:
+
+    class QueueStreamHandler(QueueHandler):
+        """ Non-blocking stream handler: records are put to a queue and
+        formatted and written in a background thread. Under uWSGI it requires
+        --enable-threads option. """
+
+        def __init__(self, stream=None):
+            super().__init__(queue.Queue(-1))
+            self.target = logging.StreamHandler(
+                stream if stream is not None else sys.stderr)
+
+            self.listener = QueueListener(self.queue, self.target)
+            self.listener.start()
+            self._stopped = False
+            atexit.register(self.stop)
+
+        def setFormatter(self, fmt):
+            self.target.setFormatter(fmt)
+
+        def prepare(self, record):
+            # Record is consumed in the same process, so there is no need to
+            # format it here as base class does. Only message is merged with
+            # arguments because they can be changed after the call.
+            record.msg = record.getMessage()
+            record.args = None
+            return record
+
+        def stop(self):
+            if not self._stopped:
+                self._stopped = True
+                self.listener.stop()
+                self.target.flush()
+
+        def close(self):
+            self.stop()
+            self.target.close()
+            super().close()
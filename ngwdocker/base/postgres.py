@@ -1,10 +1,9 @@
-import tarfile
 from textwrap import dedent
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
 from ngwdocker.image import Image, ImageEvent, AptEvent, HomeEvent, VirtualenvEvent
-from ngwdocker.util import copyfiles
+from ngwdocker.util import copyfiles, write_tar
 
 
 class PostgresImage(Image):
@@ -26,6 +25,7 @@ class PostgresImage(Image):
         super().__init__()
         self.postgres_version = "10"
         self.postgis_version = "2.5"
+        self.cluster_template = False
 
     def configurator(self):
         super().configurator()
@@ -65,8 +65,12 @@ class PostgresImage(Image):
 
         home = self.on_home(self, user='postgres')
         home.directory('data', 'data/postgres')
+        home.directory('wal', 'wal/postgres', 'temp', 'temp/postgres')
         home.directory('config', 'config/postgres')        
         home.directory('secret')
+        # Mount points of instance secret volumes have to exist in image,
+        # otherwise docker creates them owned by root.
+        home.directory(*('secret/{}'.format(i) for i in self.context.instances))
         home.command(
             'chown -R $NGWUSER:$NGWUSER /var/run/postgresql /var/lib/postgresql',
             'ln -s $NGWROOT/data/postgres /var/lib/postgresql/data')
@@ -89,12 +93,18 @@ class PostgresImage(Image):
             # Config directory template
             config_path = tmp_path / 'build' / 'config'
             config_path.mkdir(parents=True)
-            with tarfile.open(config_path / 'postgres.tar.gz', 'w:gz') as config_tar:
-                config_src = Path(__file__).parent / 'image' / 'postgres' / 'config' / 'postgres'
-                config_tar.add(config_src, 'postgres')
+            config_src = Path(__file__).parent / 'image' / 'postgres' / 'config' / 'postgres'
+            write_tar(config_path / 'postgres.tar.gz', [(config_src, 'postgres'), ])
 
             self.copy(tmp_path, '$NGWROOT', chown='$NGWUSER:$NGWUSER')
 
+        if self.cluster_template:
+            # Initialized cluster with nextgisweb database is copied by
+            # entrypoint on first start instead of running initdb.
+            self.run([
+                '$NGWROOT/bin/postgres-initdb $NGWROOT/build/template/postgres --database ""',
+            ], sep=True)
+
         self.environment['NGWDOCKER_POSTGRES_INITDB'] = 'yes'
         if self.context.default_instance:
             self.environment['NGWDOCKER_DEFAULT_INSTANCE'] = 'yes'
@@ -102,6 +112,7 @@ class PostgresImage(Image):
         self.expose.append('5432')
 
         self.entrypoint = ['{}/bin/docker-entrypoint'.format(home.home), ]
+        self.set_healthcheck(['{}/bin/healthcheck'.format(home.home), ], start_period='60s')
         self.command = ['postgres', ]
 
         finish = self.on_finish(self)
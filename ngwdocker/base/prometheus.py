@@ -0,0 +1,43 @@
+import io
+from collections import OrderedDict
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import yaml
+
+from ngwdocker.image import Image
+
+
+class PrometheusImage(Image):
+    name = 'prometheus'
+
+    def __init__(self):
+        super().__init__()
+        self.base = 'prom/prometheus:v2.45.0'
+        self.scrape_interval = '15s'
+        self.targets = OrderedDict()
+
+    def add_target(self, job, target):
+        self.targets.setdefault(job, list()).append(target)
+
+    def configure(self):
+        # Prometheus image isn't debian based, so common apt layers are
+        # skipped and only bundled scrape config is added.
+        self.write('FROM {}'.format(self.base), '')
+
+        scrape_configs = [
+            dict(job_name=job, static_configs=[dict(targets=targets)])
+            for job, targets in self.targets.items()]
+
+        config = {
+            'global': dict(scrape_interval=self.scrape_interval),
+            'scrape_configs': scrape_configs}
+
+        with TemporaryDirectory() as tmp_dir:
+            config_file = Path(tmp_dir) / 'prometheus.yml'
+            with io.open(config_file, 'w') as fd:
+                yaml.safe_dump(config, fd, default_flow_style=False)
+            self.copy(config_file, '/etc/prometheus/prometheus.yml')
+
+        self.expose.append('9090')
+        self.close()
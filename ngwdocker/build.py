@@ -0,0 +1,185 @@
+import io
+import os
+import re
+import json
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from time import perf_counter
+
+import yaml
+from loguru import logger
+
+# Cached step markers of classic builder and BuildKit
+RE_STEP = re.compile(r'^(?:Step \d+/\d+ :|#\d+ \[[^\]]+\])')
+RE_CACHED = re.compile(r'^(?: ---> Using cache|#\d+ CACHED)')
+
+
+class BuildImage:
+
+    def __init__(self, name, context, tag):
+        self.name = name
+        self.context = context
+        self.tag = tag
+        self.args = OrderedDict()
+        self.aliases = list()
+        self.cache_from = list()
+        self.depends_on = set()
+
+        self.status = None
+        self.time = 0.0
+        self.steps = 0
+        self.cached = 0
+
+    def command(self):
+        cmd = ['docker', 'build', '--tag', self.tag]
+        for a in self.aliases:
+            cmd.extend(('--tag', a))
+        for k, v in self.args.items():
+            cmd.extend(('--build-arg', '{}={}'.format(k, v)))
+        for c in self.cache_from:
+            cmd.extend(('--cache-from', c))
+        # BuildKit uses pulled images as cache only with inline metadata
+        cmd.extend(('--build-arg', 'BUILDKIT_INLINE_CACHE=1'))
+        cmd.append(str(self.context))
+        return cmd
+
+
+def load_images(context):
+    """ Images of context and their dependencies with tags, build arguments
+    and cache sources from generated compose file. Services sharing build
+    context are built once. """
+
+    if not context.compose_path.is_file():
+        raise RuntimeError("File [{}] not found, run ngwdocker first!".format(
+            context.compose_path))
+    with io.open(context.compose_path, 'r') as fd:
+        compose = yaml.safe_load(fd)
+
+    # Same project name as docker-compose uses by default
+    project = re.sub(r'[^a-z0-9]', '', context.compose_path.resolve().parent.name.lower())
+
+    services = OrderedDict()
+    for sname, service in compose['services'].items():
+        sbuild = service.get('build')
+        if sbuild is not None:
+            services.setdefault(Path(sbuild['context']).name, (sname, service))
+
+    images = OrderedDict()
+    for name, cimage in context.images.items():
+        if name not in services:
+            raise RuntimeError("Image [{}] not found in [{}], run ngwdocker first!".format(
+                name, context.compose_path))
+        sname, service = services[name]
+        sbuild = service['build']
+
+        tag = service.get('image', '{}_{}'.format(project, sname))
+        image = images[name] = BuildImage(name, Path(sbuild['context']), tag)
+        image.args.update(sbuild.get('args') or dict())
+        image.cache_from.extend(sbuild.get('cache_from') or ())
+        image.depends_on.update(d.name for d in cimage.depends_on)
+
+    return images
+
+
+def registry_has(tag):
+    return subprocess.call(
+        ['docker', 'manifest', 'inspect', tag],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def build_image(image, log_path):
+    start = perf_counter()
+    with io.open(log_path, 'w') as log:
+        # Dockerfiles may use syntax directive and cache mounts
+        proc = subprocess.Popen(
+            image.command(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            env=dict(os.environ, DOCKER_BUILDKIT='1'), universal_newlines=True)
+        for line in proc.stdout:
+            log.write(line)
+            if RE_STEP.match(line):
+                image.steps += 1
+            if RE_CACHED.match(line):
+                image.cached += 1
+        proc.wait()
+
+    image.time = perf_counter() - start
+    image.status = 'built' if proc.returncode == 0 else 'failed'
+    return image
+
+
+def build(context, jobs=2, skip_existing=True):
+    images = load_images(context)
+    build_path = context.build_path
+    manifest = dict()
+    manifest_file = build_path / 'images.json'
+    if manifest_file.is_file():
+        with io.open(manifest_file, 'r') as fd:
+            manifest = json.load(fd)
+
+    # Content tagged images also get floating tag used as cache source
+    for name, image in images.items():
+        if name in manifest and manifest[name]['tag'] != image.tag:
+            image.aliases.append(manifest[name]['tag'])
+
+    log_dir = build_path / 'log'
+    log_dir.mkdir(exist_ok=True)
+
+    pending = OrderedDict(images)
+    running = dict()
+    start = perf_counter()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            # Images found in registry complete immediately and can make
+            # dependent images ready, so repeat until nothing changes.
+            progress = True
+            while progress:
+                progress = False
+                for name, image in list(pending.items()):
+                    deps = [images[d] for d in image.depends_on]
+                    if any(d.status is None for d in deps):
+                        continue
+
+                    del pending[name]
+                    progress = True
+                    if any(d.status in ('failed', 'skipped') for d in deps):
+                        image.status = 'skipped'
+                        logger.error("Image [{}] skipped, dependency failed", name)
+                        continue
+
+                    # Content tag already pushed, nothing to do
+                    if skip_existing and name in manifest and registry_has(image.tag):
+                        image.status = 'exists'
+                        logger.info("Image [{}] found in registry as [{}]", name, image.tag)
+                        continue
+
+                    logger.info("Building image [{}]...", name)
+                    log_path = log_dir / '{}.log'.format(name)
+                    running[executor.submit(build_image, image, log_path)] = image
+
+            if len(running) == 0:
+                if len(pending) > 0:
+                    raise RuntimeError("Circular dependency between images [{}]!".format(
+                        ', '.join(pending)))
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                image = running.pop(future)
+                future.result()
+                if image.status == 'failed':
+                    logger.error(
+                        "Image [{}] build failed, see [{}]",
+                        image.name, log_dir / '{}.log'.format(image.name))
+                else:
+                    logger.info("Image [{}] built in {:.1f}s", image.name, image.time)
+
+    for image in images.values():
+        logger.info(
+            "{:<16} {:<8} {:>8.1f}s {:>4}/{:<4} steps cached",
+            image.name, image.status, image.time, image.cached, image.steps)
+    logger.info("Total build time {:.1f}s", perf_counter() - start)
+
+    return all(i.status in ('built', 'exists') for i in images.values())
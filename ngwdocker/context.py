@@ -1,7 +1,11 @@
 import io
-import importlib
+import re
+import json
+import difflib
+import importlib.util
+from hashlib import sha256
 from pathlib import Path
-from shutil import rmtree
+from tempfile import TemporaryDirectory
 from collections import OrderedDict
 from copy import deepcopy
 
@@ -9,8 +13,34 @@ import yaml
 from loguru import logger
 
 from .package import PackageBase
-from .image import Image
-from .util import read_envfile, write_envfile, git_checkout
+from .image import Image, event_bus
+from .profile import Profiler
+from .plugin import PluginIndex
+from .util import (
+    read_envfile, write_envfile, git_checkout, parse_size,
+    tree_digest, ndjson, compare_tree, sync_tree, write_changed)
+
+# Instance name is used as postgres role and database name, so it can't be
+# one of existing roles or databases.
+RESERVED_INSTANCE_NAMES = ('postgres', 'nextgisweb', 'replicator', 'template0', 'template1')
+
+
+class ComposeDumper(yaml.Dumper):
+    """ Dumper with OrderedDict support, volume mounts are dumped in flow
+    style. Global yaml representers are left untouched. """
+
+
+def _dict_representer(dumper, data):
+    flow_style = False
+    if 'type' in data and 'source' in data and 'target' in data:
+        flow_style = True
+
+    return dumper.represent_mapping(
+        'tag:yaml.org,2002:map', data.items(),
+        flow_style=flow_style)
+
+
+ComposeDumper.add_representer(OrderedDict, _dict_representer)
 
 
 class Context:
@@ -28,12 +58,28 @@ class Context:
         self.registry_prefix = self.settings['registry'].get('prefix', None)
         self.registry_suffix = self.settings['registry'].get('suffix', None)
         self.registry_version = self.settings['registry'].get('version', None)
+        self.registry_content_tag = self.settings['registry'].get('content_tag', False)
 
         if 'stack' not in self.settings:
             self.settings['stack'] = dict()
         self.stack_enabled = len(self.settings['stack']) > 0
         self.stack_placement = self.settings['stack'].get('placement')
 
+        self.wait_healthy = settings.get('wait_healthy', False)
+
+        self.context_size = settings.get('context_size') or dict()
+
+        # Additional application instances sharing one postgres service,
+        # single instance without name is used if nothing is declared.
+        self.instances = OrderedDict()
+        for iname, isettings in (settings.get('instance') or dict()).items():
+            if not re.match(r'^[a-z][a-z0-9_]*$', iname):
+                raise RuntimeError("Invalid instance name [{}]!".format(iname))
+            if iname in RESERVED_INSTANCE_NAMES or iname.startswith('pg_'):
+                raise RuntimeError(
+                    "Instance name [{}] is reserved by postgres or ngwdocker!".format(iname))
+            self.instances[iname] = isettings if isettings is not None else dict()
+
         self.autoload = settings.get('autoload', True)
         if 'package' not in self.settings:
             self.settings['package'] = dict()
@@ -41,6 +87,9 @@ class Context:
         self.package_path = path / 'package'
         self.build_path = path / 'build'
 
+        # Written to current directory where docker-compose looks for it
+        self.compose_path = Path('docker-compose.yaml')
+
         self.packages = OrderedDict()
 
         self.images = OrderedDict()
@@ -50,6 +99,11 @@ class Context:
         self.envfile = None
         self.default_instance = True
 
+        # Compute output without writing anything
+        self.plan = False
+
+        self.profiler = Profiler()
+
     @classmethod
     def from_file(cls, filename):
         if filename.exists():
@@ -69,11 +123,11 @@ class Context:
         return cls(path=filename.parent, settings=settings)
 
     def load_packages(self):
-        if not self.package_path.is_dir():
+        if not self.package_path.is_dir() and not self.plan:
             logger.info("Creating [package] directory...")
             self.package_path.mkdir()
         
-        if not self.build_path.is_dir():
+        if not self.build_path.is_dir() and not self.plan:
             logger.info("Creating [build] directory...")
             self.build_path.mkdir()
 
@@ -90,10 +144,11 @@ class Context:
 
             self.packages[pname] = package
 
-        from . import base
-        load_package(
-            'ngwdocker', base, base.Package,
-            Path(__file__).parent / 'base')
+        with self.profiler.phase('ngwdocker'):
+            from . import base
+            load_package(
+                'ngwdocker', base, base.Package,
+                Path(__file__).parent / 'base')
 
         # Package nextgisweb should be loaded first!
         def _skey(pname):
@@ -101,7 +156,7 @@ class Context:
 
         def iter_package():
             if self.autoload:
-                for tpth in self.package_path.iterdir():
+                for tpth in (self.package_path.iterdir() if self.package_path.is_dir() else ()):
                     if not tpth.is_dir() or tpth.name.startswith('.'):
                         continue
                     yield tpth.name
@@ -120,6 +175,8 @@ class Context:
                                     k, tpth))
                     yield k
 
+        index = PluginIndex(self.path / '.ngwdocker-index.json')
+
         for pname in sorted(iter_package(), key=_skey):
             pth = self.package_path / pname
 
@@ -133,73 +190,114 @@ class Context:
             ):
                 continue
 
-            repo_settings = pkg_settings.get('repository')
-            if repo_settings is not None:
-                logger.debug(
-                    'Updating package [{}] from repository [{}]',
-                    pname, repo_settings['remote'])
-                git_checkout(pth, repo_settings['remote'], repo_settings['revision'])                
+            with self.profiler.phase(pname):
+                repo_settings = pkg_settings.get('repository')
+                if repo_settings is not None and not self.plan:
+                    logger.debug(
+                        'Updating package [{}] from repository [{}]',
+                        pname, repo_settings['remote'])
+                    with self.profiler.phase('git_checkout'):
+                        git_checkout(pth, repo_settings['remote'], repo_settings['revision'])
+
+                docker_py = pth / 'docker.py'
+                if not docker_py.is_file():
+                    logger.warning(
+                        "File [{}] not found! Using dummy package class.",
+                        docker_py)
+                    load_package(pname, None, PackageBase, pth)
+                    continue
+
+                # Modules which don't define anything beyond PackageBase
+                # aren't imported at all.
+                with self.profiler.phase('index'):
+                    caps = index.capabilities(pname, docker_py)
+                if len(caps) == 0:
+                    logger.debug("Skipping import of [{}], nothing declared", docker_py)
+                    load_package(pname, None, PackageBase, pth)
+                    continue
+
+                spec = importlib.util.spec_from_file_location(
+                    "{}.docker".format(pname), docker_py)
+                module = importlib.util.module_from_spec(spec)
 
-            spec = importlib.util.spec_from_file_location(
-                "{}.docker".format(pname),
-                pth / 'docker.py')
-            module = importlib.util.module_from_spec(spec)
-
-            try:
                 logger.debug("Loading {}", module)
-                spec.loader.exec_module(module)
-                pkgcls = module.Package
-            except FileNotFoundError:
-                logger.warning(
-                    "File not found for {}! Using dummy package class.",
-                    module)
-                pkgcls = PackageBase
-                module = None
-
-            load_package(pname, module, pkgcls, pth)
-
-    def initialize(self):
-        # Cleanup build directory
-        for fp in self.build_path.iterdir():
-            if fp.is_file():
-                fp.unlink()
-            else:
-                rmtree(fp)
+                event_bus.discard_module(spec.name)
+                with self.profiler.phase('import'):
+                    spec.loader.exec_module(module)
 
-        self.envfile = read_envfile(self.path / '.env')
+                load_package(pname, module, module.Package, pth)
 
-        for pname, package in self.packages.items():
-            try:
-                self._current_package = package
-                package.setup()
-            finally:
-                self._current_package = None
+        if not self.plan:
+            index.save()
+
+    def initialize(self, images=None):
+        """ Generate build contexts and compose file. If images is given only
+        build contexts of these images are synchronized, others are kept.
+        All images are configured anyway as compose file depends on them.
 
-        for pname, package in self.packages.items():
+        Build contexts are generated in a staging directory and only changed
+        files are written. In plan mode nothing is written and a list of
+        differences is returned. """
+
+        with TemporaryDirectory() as stage:
+            self.stage_path = Path(stage)
             try:
-                self._current_package = package
-                package.initialize()
+                return self._initialize(images)
             finally:
-                self._current_package = None
+                self.stage_path = None
+
+    def _initialize(self, images):
 
-        for iname, image in self.images.items():
-            image.configure()
+        # Image tags of previous run are used as cache sources
+        images_file = self.build_path / 'images.json'
+        images_prev = dict()
+        if images_file.is_file():
+            with io.open(images_file, 'r') as fd:
+                images_prev = json.load(fd)
+
+        self.envfile = read_envfile(self.path / '.env')
+        event_bus.reset_stats()
+
+        profiler = self.profiler
+        with profiler.phase('setup'):
+            for pname, package in self.packages.items():
+                try:
+                    self._current_package = package
+                    with profiler.phase(pname):
+                        package.setup()
+                finally:
+                    self._current_package = None
+
+        with profiler.phase('initialize'):
+            for pname, package in self.packages.items():
+                try:
+                    self._current_package = package
+                    with profiler.phase(pname):
+                        package.initialize()
+                finally:
+                    self._current_package = None
+
+        with profiler.phase('configure'):
+            for iname, image in self.images.items():
+                with profiler.phase(iname):
+                    image.configure()
 
         dcompose = OrderedDict()
         dcompose['version'] = '3.7'
 
         dc_services = dcompose['services'] = OrderedDict()
+        images_manifest = OrderedDict()
         stack_warn = False
         for cname, service in self.services.items():
             dc_service = dc_services[cname] = OrderedDict()
 
             if isinstance(service.image, Image):
                 sbuild = dc_service['build'] = OrderedDict()
-                sbuild['context'] = str(service.image.path)
+                sbuild['context'] = str(self.build_path / service.image.name)
                 if len(service.image.args) > 0:
                     sbuild['args'] = service.image.args
                 if self.registry_prefix is not None:
-                    img_name = self.registry_prefix + cname
+                    img_name = self.registry_prefix + service.image.name
                     if self.registry_suffix is not None:
                         img_name += self.registry_suffix
                     
@@ -216,17 +314,39 @@ class Context:
                     vflags.append('py3' if self.python3 else 'py2')
 
                     vflags.extend(service.image.flags)
-                    
-                    dc_service['image'] = img_name + (
-                        (":" + '-'.join(vflags))
-                        if len(vflags) > 0 else "")
+
+                    img_tag = img_name + ":" + '-'.join(vflags)
+                    dc_service['image'] = img_tag
+
+                    if self.registry_content_tag:
+                        iname = service.image.name
+                        if iname not in images_manifest:
+                            images_manifest[iname] = self.image_manifest(
+                                service.image, service.image.path, img_tag,
+                                images_prev.get(iname))
+                        manifest = images_manifest[iname]
+                        dc_service['image'] = manifest['image']
+                        sbuild['cache_from'] = manifest['cache_from']
             else:
                 dc_service['image'] = service.image
 
+            environment = OrderedDict(service.environment)
+            if (
+                isinstance(service.image, Image) and
+                len(service.depends_on) > 0 and
+                self.is_health_gated() and
+                all(c.get_healthcheck() is not None for c in service.depends_on)
+            ):
+                # Dependencies are ready when container starts, so
+                # entrypoint can skip waiting for them.
+                environment['NGWDOCKER_DEPENDS_HEALTHY'] = 'yes'
+
+            if service.user is not None:
+                dc_service['user'] = service.user
             if service.command is not None:
                 dc_service['command'] = service.command
-            if len(service.environment) > 0:
-                dc_service['environment'] = service.environment
+            if len(environment) > 0:
+                dc_service['environment'] = environment
             if len(service.ulimits) > 0:
                 dc_service['ulimits'] = service.ulimits
             if len(service.volumes) > 0:
@@ -234,7 +354,18 @@ class Context:
             if len(service.ports) > 0:
                 dc_service['ports'] = service.ports
             if len(service.depends_on) > 0:
-                dc_service['depends_on'] = [c.name for c in service.depends_on]
+                if self.is_health_gated():
+                    dc_service['depends_on'] = OrderedDict([
+                        (c.name, OrderedDict(condition=(
+                            'service_healthy' if c.get_healthcheck() is not None
+                            else 'service_started')))
+                        for c in service.depends_on])
+                else:
+                    dc_service['depends_on'] = [c.name for c in service.depends_on]
+
+            healthcheck = service.get_healthcheck()
+            if healthcheck is not None:
+                dc_service['healthcheck'] = deepcopy(healthcheck)
 
             if service.restart and self.is_production():
                 dc_service['restart'] = 'unless-stopped'
@@ -252,9 +383,17 @@ class Context:
                     dc_deploy['restart_policy'] = OrderedDict(condition='on-failure')
                 dc_deploy['endpoint_mode'] = 'dnsrr'
 
+            if len(service.limits) > 0:
+                dc_deploy = dc_service.setdefault('deploy', OrderedDict())
+                dc_deploy['resources'] = OrderedDict(limits=service.limits)
+
         def _volume_sort_key(item):
             if item[0].startswith('data_'):
                 return (10, item[0])
+            elif item[0].startswith('wal_'):
+                return (11, item[0])
+            elif item[0].startswith('temp_'):
+                return (12, item[0])
             elif item[0].startswith('config_'):
                 return (20, item[0])
             elif item[0].startswith('secret'):
@@ -266,27 +405,104 @@ class Context:
             self.volumes.items(),
             key=_volume_sort_key))
 
-        def dict_representer(dumper, data):
-            flow_style = False
-            if 'type' in data and 'source' in data and 'target' in data:
-                flow_style = True
-                
-            return dumper.represent_mapping(
-                'tag:yaml.org,2002:map', data.items(),
-                flow_style=flow_style)
+        with profiler.phase('compose_dump'):
+            compose_text = yaml.dump(
+                dcompose, Dumper=ComposeDumper, default_flow_style=False)
 
-        yaml.add_representer(OrderedDict, dict_representer)
+        if len(images_manifest) > 0:
+            with io.open(self.stage_path / 'images.json', 'w') as fd:
+                json.dump(images_manifest, fd, indent=2)
+                fd.write('\n')
 
-        with io.open('docker-compose.yaml', 'w') as fd:
-            yaml.dump(dcompose, fd, default_flow_style=False)
+        if self.plan:
+            return self.plan_report(compose_text, images)
 
-        write_envfile(self.path / '.env', self.envfile)
+        with profiler.phase('sync'):
+            if images is None:
+                changes = sync_tree(self.stage_path, self.build_path)
+            else:
+                changes = 0
+                for fp in self.stage_path.iterdir():
+                    if fp.is_dir():
+                        if fp.name in images:
+                            changes += sync_tree(fp, self.build_path / fp.name)
+                    elif write_changed(self.build_path / fp.name, fp.read_text()):
+                        changes += 1
+            logger.debug("Build directory synchronized, {} changes", changes)
+
+            if write_changed(self.compose_path, compose_text):
+                logger.debug("File [docker-compose.yaml] updated")
+
+            write_envfile(self.path / '.env', self.envfile)
+
+    def plan_report(self, compose_text, images=None):
+        """ Differences between generated and existing output as lines """
+        result = list()
+
+        def diff(old, new, name):
+            for line in difflib.unified_diff(
+                old.splitlines(), new.splitlines(),
+                'a/' + name, 'b/' + name, lineterm=''
+            ):
+                result.append('    ' + line)
+
+        def dump(data):
+            return yaml.safe_dump(data, default_flow_style=False)
+
+        old = dict()
+        if self.compose_path.is_file():
+            with io.open(self.compose_path, 'r') as fd:
+                old = yaml.safe_load(fd) or dict()
+        new = yaml.safe_load(compose_text)
+
+        for section, title in (('services', 'service'), ('volumes', 'volume')):
+            osec, nsec = old.get(section) or dict(), new.get(section) or dict()
+            for key in sorted(set(osec) | set(nsec)):
+                if key not in osec:
+                    result.append('+ {} {}'.format(title, key))
+                elif key not in nsec:
+                    result.append('- {} {}'.format(title, key))
+                elif osec[key] != nsec[key]:
+                    result.append('~ {} {}'.format(title, key))
+                    diff(dump(osec[key]), dump(nsec[key]), key)
+
+        for fp in sorted(self.stage_path.iterdir()):
+            if not fp.is_dir():
+                continue
+            target = self.build_path / fp.name
+            changes = list(compare_tree(fp, target))
+            if len(changes) == 0:
+                continue
+            result.append('{} image {}'.format('~' if target.exists() else '+', fp.name))
+            for status, name in changes:
+                result.append('    {} {}'.format(status, name))
+                if name in ('Dockerfile', '.dockerignore') and status == '~':
+                    diff(
+                        (target / name).read_text(), (fp / name).read_text(),
+                        '{}/{}'.format(fp.name, name))
+
+        if images is None and self.build_path.is_dir():
+            for fp in sorted(self.build_path.iterdir()):
+                if fp.is_dir() and not (self.stage_path / fp.name).exists():
+                    result.append('- image {}'.format(fp.name))
+
+        # Values aren't shown, they are secrets
+        envfile = read_envfile(self.path / '.env')
+        for key in sorted(set(envfile) | set(self.envfile)):
+            if key not in envfile:
+                result.append('+ env {}'.format(key))
+            elif key not in self.envfile:
+                result.append('- env {}'.format(key))
+            elif envfile[key] != self.envfile[key]:
+                result.append('~ env {}'.format(key))
+
+        return result
 
     def add_image(self, image):
         name = image.name
 
         image.package = self._current_package
-        image.path = path = self.build_path / name
+        image.path = path = self.stage_path / name
         if not path.exists():
             path.mkdir()
 
@@ -302,3 +518,38 @@ class Context:
 
     def is_production(self):
         return self.mode == 'production'
+
+    def image_manifest(self, image, path, img_tag, previous=None):
+        """ Content tag of image derived from its build context and build
+        arguments, floating and previous content tags are cache sources. """
+        digest = tree_digest(path)
+        if len(image.args) > 0:
+            digest = sha256((digest + ndjson(image.args)).encode('utf-8')).hexdigest()
+
+        manifest = OrderedDict()
+        manifest['hash'] = digest
+        manifest['image'] = img_tag + '-' + digest[:12]
+        manifest['tag'] = img_tag
+        manifest['cache_from'] = [img_tag, ]
+        if previous is not None and previous['image'] not in (
+            manifest['image'], img_tag
+        ):
+            manifest['cache_from'].append(previous['image'])
+        return manifest
+
+    def context_budget(self, image):
+        """ Warning and failure build context size limits in bytes (or None)
+        for image name. """
+        settings = dict(warn='1g', fail=None)
+        settings.update({
+            k: v for k, v in self.context_size.items()
+            if k in ('warn', 'fail')})
+        settings.update((self.context_size.get('image') or dict()).get(image) or dict())
+        return tuple(
+            parse_size(settings[k]) if settings[k] is not None else None
+            for k in ('warn', 'fail'))
+
+    def is_health_gated(self):
+        # Stack deployments ignore depends_on completely
+        stack = self.stack_enabled and not self.is_development()
+        return self.wait_healthy and not stack
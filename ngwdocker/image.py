@@ -7,10 +7,18 @@ from collections import OrderedDict
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
-from zope.event import notify
-from zope.event.classhandler import handler
+from time import perf_counter
 
-from .util import ndjson, git_commit, git_dirty
+from loguru import logger
+
+from .util import (
+    ndjson, git_commit, git_dirty, tree_digest, fix_mtimes,
+    tree_size, format_size)
+
+# Never needed inside images, stripped from copies and listed in .dockerignore
+DOCKERIGNORE = (
+    '.git', '.hg', '.svn', '__pycache__', '*.pyc', '*.pyo',
+    'node_modules', '.mypy_cache', '.pytest_cache', '.tox')
 
 
 class Image:
@@ -21,23 +29,43 @@ class Image:
         self.locale = 'C.UTF-8'
 
         self.dockerfile = list()
-        self.copy_idx = 0
+        self.syntax = None
         self.volume = list()
         self.expose = list()
         self.entrypoint = None
         self.command = None
+        self.healthcheck = None
         self.environment = OrderedDict()
         self.args = OrderedDict()
 
         self.flags = list()
 
+        # Images of the same context which have to be built before this one,
+        # for example used in FROM or COPY --from instructions.
+        self.depends_on = list()
+
+        self.dockerignore = list(DOCKERIGNORE)
+        self.context_entries = OrderedDict()
+
     @property
     def context(self):
         return self.package.context
 
+    @property
+    def slim(self):
+        """ Build in separate stage and copy only results to runtime stage. """
+        return False
+
     def configure(self):
         """ Prepeare image dockerfile and auxilary files. """
-        self.write('FROM {}'.format(self.base))
+        self.stage('build' if self.slim else None)
+        self.configurator()
+        self.close()
+
+    def stage(self, alias=None):
+        """ Start new build stage from base image. """
+        self.write('FROM {}'.format(self.base) + (
+            ' AS {}'.format(alias) if alias is not None else ''))
         self.write('ENV LC_ALL={}'.format(self.locale))
         self.write('')
 
@@ -46,10 +74,6 @@ class Image:
         preapt.package('curl', 'ca-certificates', 'gnupg', 'software-properties-common')
         preapt.notify().render()
 
-        self.configurator()
-
-        self.close()
-
     def configurator(self):
         pass
 
@@ -66,18 +90,59 @@ class Image:
         if self.command is not None:
             self.write('CMD ' + ndjson(self.command), '')
 
+        if self.healthcheck is not None:
+            hc_opts = [
+                '--{}={}'.format(k.replace('_', '-'), v)
+                for k, v in self.healthcheck.items() if k != 'test']
+            self.write('HEALTHCHECK ' + ' '.join(hc_opts) + ' \\\n    CMD '
+                       + ndjson(self.healthcheck['test'][1:]), '')
+
         for k, v in self.environment.items():
             self.write('ENV {} {}'.format(k, v))
 
         with io.open(self.path / 'Dockerfile', 'w') as fd:
+            if self.syntax is not None:
+                fd.write('# syntax={}\n'.format(self.syntax))
             for l in self.dockerfile:
                 fd.write(l + '\n')
 
+        with io.open(self.path / '.dockerignore', 'w') as fd:
+            for pattern in self.dockerignore:
+                fd.write('**/{}\n'.format(pattern))
+
+        self.check_context_size()
+
+    def check_context_size(self):
+        """ Report build context size and check it against budget """
+        for ctx_name, (files, size) in self.context_entries.items():
+            logger.debug(
+                "Context entry [{}/{}]: {} files, {}",
+                self.name, ctx_name, files, format_size(size))
+
+        files = sum(e[0] for e in self.context_entries.values())
+        size = sum(e[1] for e in self.context_entries.values())
+        warn, fail = self.context.context_budget(self.name)
+
+        message = "Build context [{}]: {} files, {}".format(
+            self.name, files, format_size(size))
+        if fail is not None and size > fail:
+            raise RuntimeError("{} exceeds limit {}!".format(
+                message, format_size(fail)))
+        elif warn is not None and size > warn:
+            logger.warning("{} exceeds {}", message, format_size(warn))
+        else:
+            logger.info(message)
+
     def write(self, *lines):
         self.dockerfile.extend(lines)
 
-    def run(self, commands, sep=False):
-        self.write('RUN ' + '; \\\n    '.join(
+    def run(self, commands, sep=False, mounts=()):
+        """ RUN instruction, mounts (like 'type=cache,target=/path') require
+        BuildKit and dockerfile syntax 1.2. """
+        if len(mounts) > 0 and self.syntax is None:
+            self.syntax = 'docker/dockerfile:1.2'
+        self.write('RUN ' + ''.join(
+            '--mount={} '.format(m) for m in mounts) + '; \\\n    '.join(
             ['set -ex', ] + [
                 cmd.replace('\n', ' \\\n    ')
                 for cmd in commands]))
@@ -90,20 +155,133 @@ class Image:
         ctx_name = re.sub(r'_{2, }', '_', ctx_name, flags=re.I)
         ctx_name = re.sub(r'(?:^_)|(?:_$)', '', ctx_name, flags=re.I)
 
-        self.copy_idx += 1
-        ctx_name = '{:02d}-{}'.format(self.copy_idx, ctx_name)
-
-        if source.is_file():
-            shutil.copy2(source, self.path / ctx_name)
-        else:
-            shutil.copytree(source, self.path / ctx_name, symlinks=True)
+        with self.context.profiler.phase('copy'):
+            tmp_path = self.path / ('.tmp-' + ctx_name)
+            if source.is_file():
+                shutil.copy2(source, tmp_path)
+            else:
+                shutil.copytree(
+                    source, tmp_path, symlinks=True,
+                    ignore=shutil.ignore_patterns(*self.dockerignore))
+
+            # Name depends on content only, so other copies don't change it
+            # and identical copies are stored once.
+            ctx_name = '{}-{}'.format(ctx_name, tree_digest(tmp_path)[:12])
+            ctx_path = self.path / ctx_name
+            if ctx_path.exists():
+                if tmp_path.is_dir():
+                    shutil.rmtree(tmp_path)
+                else:
+                    tmp_path.unlink()
+            else:
+                tmp_path.rename(ctx_path)
+                fix_mtimes(ctx_path)
+                self.context_entries[ctx_name] = tree_size(ctx_path)
         self.write('COPY {} {} {}'.format(
             '' if chown is None else ('--chown=' + chown),
             ctx_name, target))
 
+    def copy_from(self, stage, source, target, chown=None):
+        self.write('COPY --from={} {}{} {}'.format(
+            stage, '' if chown is None else ('--chown=' + chown + ' '),
+            source, target))
+
     def add_flag(self, flag):
         self.flags.append(flag)
 
+    def set_healthcheck(self, command, interval='10s', timeout='5s',
+                        start_period='30s', retries=3):
+        self.healthcheck = OrderedDict(
+            test=['CMD', ] + command,
+            interval=interval, timeout=timeout,
+            start_period=start_period, retries=retries)
+
+
+def home_ids(context):
+    """ User and group ids of container user (same as local user in
+    development mode). """
+    is_linux = platform.system() == 'Linux'
+    is_root = is_linux and os.getuid() == 0
+
+    if context.is_development() and is_linux and not is_root:
+        return os.getuid(), os.getgid()
+    else:
+        return 1000, 1000
+
+
+class EventHandler:
+
+    def __init__(self, cls, function):
+        self.cls = cls
+        self.function = function
+        self.name = '{}:{}.{}'.format(
+            cls.__name__, function.__module__, function.__qualname__)
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, event):
+        with event.image.context.profiler.phase(self.name):
+            start = perf_counter()
+            try:
+                self.function(event)
+            finally:
+                self.count += 1
+                self.time += perf_counter() - start
+
+
+class EventBus:
+    """ Dispatcher for image events. Handlers of an event class and its
+    bases are resolved once per event class (in MRO order, as
+    zope.event.classhandler does) and cached until a new handler is
+    registered. """
+
+    def __init__(self):
+        self.handlers = OrderedDict()
+        self._resolved = dict()
+
+    def register(self, cls, function):
+        handler = EventHandler(cls, function)
+        self.handlers.setdefault(cls, list()).append(handler)
+        self._resolved.clear()
+        return handler
+
+    def discard_module(self, module):
+        """ Remove handlers registered by module before it's loaded again """
+        for cls, handlers in self.handlers.items():
+            handlers[:] = [h for h in handlers if h.function.__module__ != module]
+        self._resolved.clear()
+
+    def resolve(self, cls):
+        result = self._resolved.get(cls)
+        if result is None:
+            result = self._resolved[cls] = tuple(
+                h for c in cls.__mro__
+                for h in self.handlers.get(c, ()))
+        return result
+
+    def dispatch(self, event):
+        for handler in self.resolve(event.__class__):
+            handler(event)
+
+    def reset_stats(self):
+        for handler in self.iter_handlers():
+            handler.count = 0
+            handler.time = 0.0
+
+    def iter_handlers(self):
+        for handlers in self.handlers.values():
+            yield from handlers
+
+    def slow_handlers(self, threshold):
+        """ Handlers with cumulative time over threshold (in seconds),
+        slowest first. """
+        return sorted(
+            (h for h in self.iter_handlers() if h.time >= threshold),
+            key=lambda h: h.time, reverse=True)
+
+
+event_bus = EventBus()
+
 
 class ImageEvent:
 
@@ -112,11 +290,14 @@ class ImageEvent:
 
     @classmethod
     def handler(cls, function):
-        @handler(cls)
-        def _handler(event):
-            function(event)
+        event_bus.register(cls, function)
+        return function
 
     def notify(self):
+        event_bus.dispatch(self)
+
+        # Subscribers registered with zope.event directly
+        from zope.event import notify
         notify(self)
         return self
 
@@ -126,44 +307,71 @@ class AptEvent(ImageEvent):
     def __init__(self, image):
         super().__init__(image)
         self.packages = list()
+        self.packages_build = list()
+        self.packages_runtime = list()
         self.commands = [
             'export DEBIAN_FRONTEND=noninteractive',
             'apt-get update',
         ]
+        self.commands_runtime = list(self.commands)
         self.commands_cleanup = [
             'rm -rf /var/lib/apt/lists/*'
         ]
 
     def add_key(self, url):
-        self.commands.append(
+        self.command(
             "curl --silent {} | APT_KEY_DONT_WARN_ON_DANGEROUS_USAGE=DontWarn "
             "apt-key add - > /dev/null".format(url))
 
     def add_repository(self, repo):
-        self.commands.append('add-apt-repository --yes "{}"'.format(repo))
+        self.command('add-apt-repository --yes "{}"'.format(repo))
 
     def package(self, *packages):
         self.packages.extend(packages)
 
+    def build_package(self, *packages):
+        """ Packages required only for building, like compilers and headers. """
+        self.packages_build.extend(packages)
+
+    def runtime_package(self, *packages):
+        """ Packages required only in runtime stage of slim images, like
+        shared libraries which are dependencies of build packages. """
+        self.packages_runtime.extend(packages)
+
     def pop(self):
-        if len(self.packages) > 0:
-            self.commands.extend([
+        def install(packages):
+            return (
                 'apt-get --yes -qq install --no-install-recommends \n    '
-                + ' '.join(self.packages)])
-            self.packages = list()
+                + ' '.join(packages))
+
+        packages = self.packages + self.packages_build + self.packages_runtime
+        if len(packages) > 0:
+            self.commands.append(install(packages))
+
+        packages = self.packages + self.packages_runtime
+        if len(packages) > 0:
+            self.commands_runtime.append(install(packages))
+
+        self.packages = list()
+        self.packages_build = list()
+        self.packages_runtime = list()
 
     def command(self, *commands):
         self.commands.extend(commands)
+        self.commands_runtime.extend(commands)
 
     def cleanup(self, *commands):
         self.commands_cleanup.extend(commands)
 
-    def get_commands(self):
+    def get_commands(self, runtime=False):
         self.pop()
-        return self.commands + self.commands_cleanup
+        return (
+            self.commands_runtime if runtime
+            else self.commands
+        ) + self.commands_cleanup
 
-    def render(self):
-        self.image.run(self.get_commands(), sep=True)
+    def render(self, runtime=False):
+        self.image.run(self.get_commands(runtime=runtime), sep=True)
 
 
 class HomeEvent(ImageEvent):
@@ -174,15 +382,7 @@ class HomeEvent(ImageEvent):
         self.user = user
         self.home = '/opt/ngw'
 
-        is_linux = platform.system() == 'Linux'
-        is_root = is_linux and os.getuid() == 0
-
-        if image.context.is_development() and is_linux and not is_root:
-            self.uid = os.getuid()
-            self.gid = os.getgid()
-        else:
-            self.uid = 1000
-            self.gid = 1000
+        self.uid, self.gid = home_ids(image.context)
 
         self.commands = list()
         self.directories = list()
@@ -220,6 +420,8 @@ class VirtualenvEvent(ImageEvent):
         super().__init__(image)
         self.path = path
         self.requirements = list()
+        self.commands_env = list()
+        self.commands_create = list()
         self.commands_prepare = list()
         self.commands_before_install = list()
         self.commands_after_install = list()
@@ -229,16 +431,28 @@ class VirtualenvEvent(ImageEvent):
         self.package_path = self.ngwroot_path / 'package'
         self.package_path.mkdir()
 
+        # Script for lockfile generation inside container
+        lock_script = self.ngwroot_path / 'bin' / 'virtualenv-lock'
+        lock_script.parent.mkdir()
+        shutil.copyfile(Path(__file__).parent / 'virtualenv_lock.py', lock_script)
+        lock_script.chmod(0o755)
+
+        self.lockfile = image.context.path / 'lock' / '{}-{}.txt'.format(
+            image.name, 'py3' if image.context.python3 else 'py2')
+        if not self.lockfile.is_file():
+            self.lockfile = None
+
+        # Environment is repeated in each RUN instruction which uses pip
         if not self.image.context.python3:
-            self.before_install('export PYTHONWARNINGS=ignore:DEPRECATION::pip._internal.cli.base_command')  # NOQA: E501
+            self.commands_env.append('export PYTHONWARNINGS=ignore:DEPRECATION::pip._internal.cli.base_command')  # NOQA: E501
 
-        self.before_install(
+        self.commands_create.extend((
             (
                 'python3 -m venv' if self.image.context.python3
                 else '/usr/bin/virtualenv'
             ) + ' ' + self.path,
             "{}/bin/pip install --upgrade pip setuptools".format(self.path)
-        )
+        ))
 
     def requirement(self, *requirements):
         self.requirements.extend(requirements)
@@ -255,18 +469,54 @@ class VirtualenvEvent(ImageEvent):
     def after_install(self, *commands):
         self.commands_after_install.extend(commands)
 
+    def locked(self):
+        """ Normalized names of distributions pinned in lockfile """
+        result = set()
+        with io.open(self.lockfile, 'r') as fd:
+            for line in fd:
+                m = re.match(r'^([A-Za-z0-9_.\-]+)==', line)
+                if m:
+                    result.add(re.sub(r'[-_.]+', '-', m.group(1)).lower())
+        return result
+
+    def get_lock_commands(self):
+        """ Virtualenv creation and installation of all pinned dependencies,
+        rendered before package files are copied to be cached separately. """
+        return (
+            self.commands_env +
+            self.commands_create + [
+                self.path + '/bin/pip install --no-cache-dir --no-deps '
+                '--require-hashes -r ' + self.path + '.lock'])
+
     def get_commands(self):
         install = []
         cmd_local_version = []
+        local_names = []
 
         if len(self.requirements) > 0:
+            requirements = self.requirements
+            pip_install = self.path + '/bin/pip install --no-cache-dir'
+            if self.lockfile is not None:
+                # Dependencies are already installed from lockfile
+                locked = self.locked()
+                requirements = list()
+                for r in self.requirements:
+                    if isinstance(r, str):
+                        rname = re.sub(r'[-_.]+', '-', re.split(r'[<>=!~\[; ]', r)[0]).lower()
+                        if rname in locked:
+                            continue
+                        logger.warning(
+                            "Requirement [{}] not found in lockfile [{}]",
+                            r, self.lockfile)
+                    requirements.append(r)
+                pip_install += ' --no-deps'
+
             terms = [
                 (('-e ' + r.target) if not isinstance(r, str) else r)
-                for r in self.requirements]
+                for r in requirements]
 
-            install.append(
-                self.path + '/bin/pip install --no-cache-dir \n    '
-                + '\n    '.join(terms))
+            if len(terms) > 0:
+                install.append(pip_install + ' \n    ' + '\n    '.join(terms))
 
         if len(self.requirements) > 0:
             envar_site = False
@@ -274,6 +524,7 @@ class VirtualenvEvent(ImageEvent):
                 if isinstance(req, str):
                     continue
 
+                local_names.append(req.name)
                 if not envar_site:
                     sp_py = 'import distutils.sysconfig as sc; print(sc.get_python_lib())'
                     cmd_site = "SITE=$({}/bin/python -c '{}')".format(self.path, sp_py)
@@ -296,11 +547,29 @@ class VirtualenvEvent(ImageEvent):
                         "sed -ri 's/^(Version:[^\\+]+).*/\\1+{1}/gi' "
                         "$SITE/{0}.egg-info/PKG-INFO".format(req.name, local))
 
-        cmd_main = (
-            self.commands_prepare +
-            self.commands_before_install +
-            install +
-            self.commands_after_install)
+        if len(local_names) > 0:
+            # Local packages aren't editable after egg-link is replaced, so
+            # virtualenv-lock excludes them by name.
+            install.append("echo {} > {}/virtualenv-lock.exclude".format(
+                ' '.join(local_names), self.path))
+
+        if self.lockfile is not None:
+            # Dependencies missing in lockfile aren't installed with --no-deps
+            cmd_main = (
+                self.commands_prepare +
+                self.commands_env +
+                self.commands_before_install +
+                install +
+                self.commands_after_install +
+                [self.path + '/bin/pip check', ])
+        else:
+            cmd_main = (
+                self.commands_prepare +
+                self.commands_env +
+                self.commands_create +
+                self.commands_before_install +
+                install +
+                self.commands_after_install)
 
         if self.image.context.is_development():
             # Move local version to separate layer in development mode
@@ -309,6 +578,10 @@ class VirtualenvEvent(ImageEvent):
             return (cmd_main + cmd_local_version, )
 
     def render(self):
+        if self.lockfile is not None:
+            self.image.copy(self.lockfile, self.path + '.lock', chown='$NGWUSER:$NGWUSER')
+            self.image.run(self.get_lock_commands(), sep=True)
+
         self.image.copy(self.ngwroot_path, '$NGWROOT/', chown='$NGWUSER:$NGWUSER')
         for cmd_set in self.get_commands():
             self.image.run(cmd_set, sep=True)
@@ -326,11 +599,21 @@ class Service:
         self.volumes = list()
         self.ports = list()
         self.restart = False
+        self.healthcheck = None
+        self.user = None
+        self.limits = OrderedDict()
 
     @property
     def context(self):
         return self.package.context
 
+    def get_healthcheck(self):
+        if self.healthcheck is not None:
+            return self.healthcheck
+        elif isinstance(self.image, Image):
+            return self.image.healthcheck
+        return None
+
     def add_volume(self, volume, target):
         self.volumes.append(OrderedDict(
             type='volume', source=volume,
@@ -340,3 +623,9 @@ class Service:
         self.volumes.append(OrderedDict(
             type='bind', source=path,
             target=target))
+
+    def add_tmpfs(self, target, size=None):
+        volume = OrderedDict(type='tmpfs', target=target)
+        if size is not None:
+            volume['tmpfs'] = OrderedDict(size=size)
+        self.volumes.append(volume)
@@ -1,6 +1,4 @@
 import io
-from packaging.version import Version
-from loguru import logger
 
 
 class PackageBase(object):
@@ -32,6 +30,10 @@ class PackageBase(object):
         if hasattr(self, '_version'):
             return self._version
 
+        # Imported here to keep CLI startup fast
+        from packaging.version import Version
+        from loguru import logger
+
         vfile = self.path / 'VERSION'
         if vfile.is_file():
             with io.open(vfile, 'r') as fd:
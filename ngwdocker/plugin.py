@@ -0,0 +1,114 @@
+import io
+import sys
+import ast
+import json
+from hashlib import sha1
+from collections import OrderedDict
+
+
+# Imports of these modules have no side effects for ngwdocker
+SAFE_IMPORTS = (
+    'ngwdocker', 'io', 'os', 're', 'sys', 'pathlib', 'collections',
+    'loguru', 'packaging')
+
+
+def _is_safe_import(node):
+    if isinstance(node, ast.ImportFrom):
+        names = [node.module] if node.level == 0 and node.module else [None]
+    else:
+        names = [a.name for a in node.names]
+    return all(
+        n is not None and n.split('.')[0] in SAFE_IMPORTS
+        for n in names)
+
+
+def _is_docstring(node):
+    if not isinstance(node, ast.Expr):
+        return False
+    if sys.version_info < (3, 8):
+        return isinstance(node.value, ast.Str)
+    return isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+
+
+def capabilities(source):
+    """ Find out what docker.py does without importing it. Returns a list of
+    Package methods, event handlers and other module level statements which
+    require the module to be imported. Empty list means the module is
+    equivalent to PackageBase. """
+
+    result = list()
+    package = False
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            if not _is_safe_import(node):
+                result.append('import.{}'.format(node.lineno))
+        elif _is_docstring(node):
+            continue
+        elif isinstance(node, ast.ClassDef) and node.name == 'Package':
+            package = True
+            base = node.bases[0] if len(node.bases) == 1 else None
+            if (
+                len(node.decorator_list) > 0 or len(node.keywords) > 0
+                or not (isinstance(base, ast.Name) and base.id == 'PackageBase')
+            ):
+                result.append('package.class')
+            for item in node.body:
+                if isinstance(item, ast.Pass) or _is_docstring(item):
+                    continue
+                elif isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    result.append('package.' + item.name)
+                else:
+                    result.append('package.attribute')
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            for dec in node.decorator_list:
+                target = dec.func if isinstance(dec, ast.Call) else dec
+                if isinstance(target, ast.Attribute) and target.attr == 'handler':
+                    result.append('handler.' + node.name)
+                else:
+                    result.append('decorator.' + node.name)
+        else:
+            result.append('statement.{}'.format(node.lineno))
+
+    if not package:
+        result.append('package.missing')
+
+    return result
+
+
+class PluginIndex:
+    """ Cache of docker.py capabilities by content hash, so unchanged files
+    aren't parsed again. """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = OrderedDict()
+        self.dirty = False
+
+        if path.is_file():
+            try:
+                with io.open(path, 'r') as fd:
+                    self.entries.update(json.load(fd))
+            except ValueError:
+                self.dirty = True
+
+    def capabilities(self, pname, filename):
+        with io.open(filename, 'rb') as fd:
+            source = fd.read()
+        digest = sha1(source).hexdigest()
+
+        entry = self.entries.get(pname)
+        if entry is not None and entry['hash'] == digest:
+            return entry['capabilities']
+
+        caps = capabilities(source)
+        self.entries[pname] = OrderedDict(hash=digest, capabilities=caps)
+        self.dirty = True
+        return caps
+
+    def save(self):
+        if not self.dirty:
+            return
+        with io.open(self.path, 'w') as fd:
+            json.dump(self.entries, fd, indent=2)
+            fd.write('\n')
+        self.dirty = False
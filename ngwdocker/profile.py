@@ -0,0 +1,99 @@
+import io
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import perf_counter, process_time
+
+
+class Frame:
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.children = OrderedDict()
+
+    def child(self, name):
+        frame = self.children.get(name)
+        if frame is None:
+            frame = self.children[name] = Frame(name)
+        return frame
+
+    @property
+    def self_wall(self):
+        return max(self.wall - sum(c.wall for c in self.children.values()), 0.0)
+
+    def to_dict(self):
+        return OrderedDict((
+            ('name', self.name),
+            ('count', self.count),
+            ('wall', round(self.wall, 6)),
+            ('cpu', round(self.cpu, 6)),
+            ('children', [c.to_dict() for c in self.children.values()]),
+        ))
+
+
+class Profiler:
+    """ Hierarchical wall and CPU time of ngwdocker phases. Frames with the
+    same name under the same parent are aggregated. Disabled profiler
+    doesn't measure anything. """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.root = Frame('ngwdocker')
+        self.stack = [self.root]
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        frame = self.stack[-1].child(name)
+        self.stack.append(frame)
+        wall, cpu = perf_counter(), process_time()
+        try:
+            yield
+        finally:
+            frame.count += 1
+            frame.wall += perf_counter() - wall
+            frame.cpu += process_time() - cpu
+            self.stack.pop()
+
+    def close(self):
+        self.root.count = 1
+        self.root.wall = sum(c.wall for c in self.root.children.values())
+        self.root.cpu = sum(c.cpu for c in self.root.children.values())
+
+    def write_json(self, filename):
+        with io.open(filename, 'w') as fd:
+            json.dump(self.root.to_dict(), fd, indent=2)
+            fd.write('\n')
+
+    def write_folded(self, filename):
+        """ Collapsed stacks with self time in microseconds, suitable for
+        flamegraph.pl and speedscope. """
+
+        def walk(frame, path):
+            path = path + (frame.name.replace(';', ':'), )
+            value = int(round(frame.self_wall * 1e6))
+            if value > 0:
+                yield '{} {}'.format(';'.join(path), value)
+            for c in frame.children.values():
+                yield from walk(c, path)
+
+        with io.open(filename, 'w') as fd:
+            for line in walk(self.root, ()):
+                fd.write(line + '\n')
+
+    def summary(self, depth=2):
+        def walk(frame, level):
+            for c in frame.children.values():
+                yield level, c
+                if level + 1 < depth:
+                    yield from walk(c, level + 1)
+
+        for level, frame in walk(self.root, 0):
+            yield '{:<48} {:>8.3f}s wall {:>8.3f}s cpu'.format(
+                '  ' * level + frame.name, frame.wall, frame.cpu)
@@ -1,13 +1,106 @@
 from pathlib import Path
 import click
 
-from .context import Context
 
-
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option('-c', '--config', type=click.Path(exists=True, dir_okay=False, file_okay=True))
-def main(config=None):
+@click.option('--profile', is_flag=True, help="Record time of each phase to build/profile.*")
+@click.option('--cprofile', is_flag=True, help="Also run under cProfile (implies --profile)")
+@click.option('--slow-handler', type=float, default=0.5, show_default=True,
+              help="Report event handlers slower than this (seconds)")
+@click.option('--plan', is_flag=True, help="Show changes without writing anything")
+@click.pass_context
+def main(ctx, config=None, profile=False, cprofile=False, slow_handler=0.5, plan=False):
     config_path = Path('ngwdocker.yaml' if config is None else config)
+    ctx.obj = config_path
+    if ctx.invoked_subcommand is None:
+        generate(config_path, profile, cprofile, slow_handler, plan)
+
+
+@main.command()
+@click.option('--debounce', type=float, default=0.2, show_default=True,
+              help="Wait for more changes before regeneration (seconds)")
+@click.pass_obj
+def watch(config_path, debounce):
+    """ Regenerate files on changes of configuration, packages and images """
+    from .watch import watch
+    watch(config_path, debounce=debounce)
+
+
+@main.command()
+@click.option('-j', '--jobs', type=int, default=2, show_default=True,
+              help="Number of images built in parallel")
+@click.option('--skip-existing/--no-skip-existing', default=True, show_default=True,
+              help="Skip images which content tag is already in registry")
+@click.pass_obj
+def build(config_path, jobs, skip_existing):
+    """ Build images of generated docker-compose.yaml """
+    from loguru import logger
+
+    from .build import build
+    from .context import Context
+
+    # Images and their dependencies are taken from configuration, nothing
+    # is written in plan mode, generated files are only compared.
     bctx = Context.from_file(config_path)
+    bctx.plan = True
     bctx.load_packages()
-    bctx.initialize()
+    if len(bctx.initialize()) > 0:
+        logger.warning("Generated files are outdated, run ngwdocker first!")
+
+    if not build(bctx, jobs=jobs, skip_existing=skip_existing):
+        raise click.ClickException("Some images failed to build")
+
+
+def generate(config_path, profile, cprofile, slow_handler, plan=False):
+    # Heavy modules are imported here to keep --help fast
+    import cProfile
+    from loguru import logger
+
+    from .context import Context
+    from .image import event_bus
+    from .profile import Profiler
+
+    profiler = Profiler(enabled=profile or cprofile)
+    cprofiler = cProfile.Profile() if cprofile else None
+    if cprofiler is not None:
+        cprofiler.enable()
+
+    with profiler.phase('from_file'):
+        bctx = Context.from_file(config_path)
+    bctx.profiler = profiler
+    bctx.plan = plan
+    with profiler.phase('load_packages'):
+        bctx.load_packages()
+    with profiler.phase('initialize'):
+        changes = bctx.initialize()
+
+    if plan:
+        for line in changes:
+            click.echo(line)
+        if len(changes) == 0:
+            click.echo("No changes")
+
+    if cprofiler is not None:
+        cprofiler.disable()
+
+    for handler in event_bus.slow_handlers(slow_handler):
+        logger.warning(
+            "Slow event handler [{}]: {} calls, {:.3f}s",
+            handler.name, handler.count, handler.time)
+
+    if profiler.enabled:
+        profiler.close()
+        report = bctx.build_path / 'profile'
+        profiler.write_json(report.with_suffix('.json'))
+        profiler.write_folded(report.with_suffix('.folded'))
+        if cprofiler is not None:
+            cprofiler.dump_stats(str(report.with_suffix('.pstats')))
+
+        for line in profiler.summary():
+            logger.info(line)
+        for handler in event_bus.slow_handlers(0)[:10]:
+            logger.info(
+                "Event handler [{}]: {} calls, {:.3f}s",
+                handler.name, handler.count, handler.time)
+        logger.info("Profile report written to [{}.*]", report)
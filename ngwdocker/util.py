@@ -1,10 +1,14 @@
 import io
 import os
+import gzip
 import string
 import secrets
 import json
+import tarfile
+from hashlib import sha256
 from datetime import datetime
-from shutil import copytree, copy2 as copyfile
+from shutil import copytree, copy2 as copyfile, rmtree
+from pathlib import Path
 from subprocess import check_output, check_call, call, CalledProcessError, DEVNULL
 
 
@@ -19,6 +23,170 @@ def copyfiles(sources, dst, relative=None):
             copytree(sf, sd, symlinks=True)
 
 
+# Modification time of generated files and archive members, so identical
+# inputs give byte identical build contexts.
+FIXED_MTIME = int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+
+
+def _walk(path):
+    """ Path and all its descendants in sorted order """
+    yield path
+    if path.is_dir() and not path.is_symlink():
+        for child in sorted(path.iterdir()):
+            yield from _walk(child)
+
+
+def write_tar(filename, items):
+    """ Write reproducible tar.gz from (source, arcname) pairs: members are
+    sorted, owners and mtimes are fixed. Later items override earlier ones
+    with the same arcname. """
+    members = dict()
+    for source, arcname in items:
+        for p in _walk(source):
+            members[str(Path(arcname) / p.relative_to(source))] = p
+
+    with io.open(filename, 'wb') as raw, \
+            gzip.GzipFile(fileobj=raw, mode='wb', mtime=FIXED_MTIME) as gz, \
+            tarfile.open(fileobj=gz, mode='w', format=tarfile.GNU_FORMAT) as tar:
+        for arcname in sorted(members):
+            p = members[arcname]
+            ti = tar.gettarinfo(str(p), arcname)
+            ti.uid = ti.gid = 0
+            ti.uname = ti.gname = ''
+            ti.mtime = FIXED_MTIME
+            if ti.isreg():
+                with io.open(p, 'rb') as fd:
+                    tar.addfile(ti, fd)
+            else:
+                tar.addfile(ti)
+
+
+def tree_digest(path):
+    """ SHA256 of names, modes, symlink targets and contents of a file or a
+    directory tree. """
+    digest = sha256()
+    for p in _walk(path):
+        st = p.lstat()
+        digest.update('{}\0{:o}\0'.format(
+            p.relative_to(path).as_posix(), st.st_mode).encode('utf-8'))
+        if p.is_symlink():
+            digest.update(os.fsencode(os.readlink(str(p))))
+        elif p.is_file():
+            with io.open(p, 'rb') as fd:
+                for chunk in iter(lambda: fd.read(1 << 20), b''):
+                    digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def fix_mtimes(path):
+    for p in _walk(path):
+        os.utime(str(p), (FIXED_MTIME, FIXED_MTIME), follow_symlinks=False)
+
+
+def compare_tree(src, dst):
+    """ Relative paths of files which are added, removed or changed in src
+    compared to dst, as (status, path) pairs with '+', '-' and '~' status. """
+
+    def listing(root):
+        if not root.exists():
+            return dict()
+        return {
+            p.relative_to(root).as_posix(): p for p in _walk(root)
+            if p != root}
+
+    src_files, dst_files = listing(src), listing(dst)
+    for name in sorted(set(src_files) | set(dst_files)):
+        sp, dp = src_files.get(name), dst_files.get(name)
+        if dp is None:
+            yield '+', name
+        elif sp is None:
+            yield '-', name
+        elif sp.is_dir() != dp.is_dir() or sp.is_symlink() != dp.is_symlink():
+            yield '~', name
+        elif sp.is_symlink():
+            if os.readlink(str(sp)) != os.readlink(str(dp)):
+                yield '~', name
+        elif sp.is_file() and (
+            sp.stat().st_mode != dp.stat().st_mode
+            or sp.read_bytes() != dp.read_bytes()
+        ):
+            yield '~', name
+
+
+def sync_tree(src, dst):
+    """ Make dst identical to src touching only added, removed and changed
+    files, so unchanged files keep their mtimes. Returns number of changes. """
+    changes = list(compare_tree(src, dst))
+    if not dst.exists():
+        dst.mkdir(parents=True)
+
+    # Removals go deepest first, additions shallowest first
+    for status, name in sorted(changes, key=lambda c: c[1], reverse=True):
+        dp = dst / name
+        if status in ('-', '~') and (dp.exists() or dp.is_symlink()):
+            if dp.is_dir() and not dp.is_symlink():
+                rmtree(str(dp))
+            else:
+                dp.unlink()
+
+    for status, name in sorted(changes, key=lambda c: c[1]):
+        sp, dp = src / name, dst / name
+        if status == '-' or dp.exists():
+            continue
+        if sp.is_symlink():
+            os.symlink(os.readlink(str(sp)), str(dp))
+        elif sp.is_dir():
+            dp.mkdir()
+        else:
+            copyfile(str(sp), str(dp), follow_symlinks=False)
+
+    return len(changes)
+
+
+def write_changed(path, content):
+    """ Write text file only if its content differs, returns True if the
+    file was written. """
+    if path.is_file():
+        with io.open(path, 'r') as fd:
+            if fd.read() == content:
+                return False
+    with io.open(path, 'w') as fd:
+        fd.write(content)
+    return True
+
+
+def parse_size(value):
+    """ Size in bytes from integer or string with docker-like suffix
+    (b, k, m, g), like '512m'. """
+    if isinstance(value, int):
+        return value
+    value = str(value).strip().lower()
+    units = dict(b=1, k=1 << 10, m=1 << 20, g=1 << 30)
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def format_size(value):
+    if value < 1024:
+        return '{} B'.format(value)
+    for unit in ('KiB', 'MiB', 'GiB'):
+        value /= 1024
+        if value < 1024 or unit == 'GiB':
+            return '{:.1f} {}'.format(value, unit)
+
+
+def tree_size(path):
+    """ Number of files and total size in bytes of a file or a tree """
+    files, size = 0, 0
+    for p in _walk(path):
+        if p.is_file() and not p.is_symlink():
+            files += 1
+            size += p.stat().st_size
+    return files, size
+
+
 def ndjson(data):
     """ Dump data as one line json. """
     return json.dumps(data, indent=None)
@@ -35,9 +203,12 @@ def read_envfile(path):
 
 
 def write_envfile(path, values):
-    # Keep original file backup on content changes
     original = read_envfile(path)
-    if original != values and original != dict():
+    if original == values and path.exists():
+        return
+
+    # Keep original file backup on content changes
+    if original != dict():
         suffix = datetime.now().replace(microsecond=0).isoformat() \
             .replace(':', '').replace('-', '').replace('T', '-')
         os.rename(path, path.with_name(path.name + '-' + suffix))
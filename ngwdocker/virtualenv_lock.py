@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Print hash-pinned lockfile of packages installed into virtualenv. This file
+# is copied to $NGWROOT/bin/virtualenv-lock of images with virtualenv and is
+# executed inside container, so it's compatible with Python 2.
+#
+# Usage: virtualenv-lock [VIRTUALENV]
+#
+# Editable packages, pip, setuptools and local packages of the image (listed
+# in VIRTUALENV/virtualenv-lock.exclude) are excluded. Distributions are
+# downloaded the same way pip does on install (so platform wheels match the
+# image) and their SHA256 hashes are listed.
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+import subprocess
+
+
+def normalize(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def main(argv):
+    venv = argv[1] if len(argv) > 1 else os.path.join(
+        os.environ.get('NGWROOT', '/opt/ngw'), 'env')
+    pip = os.path.join(venv, 'bin', 'pip')
+
+    exclude = set()
+    exclude_file = os.path.join(venv, 'virtualenv-lock.exclude')
+    if os.path.isfile(exclude_file):
+        with open(exclude_file, 'r') as fd:
+            exclude.update(normalize(n) for n in fd.read().split())
+
+    freeze = subprocess.check_output(
+        [pip, 'freeze', '--exclude-editable'],
+        universal_newlines=True)
+    requirements = sorted(
+        (line.strip() for line in freeze.split('\n')
+         if '==' in line and not line.startswith('-')
+         and normalize(line.split('==')[0].strip()) not in exclude),
+        key=lambda r: r.lower())
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print("# Generated by virtualenv-lock, install with:")
+        print("# pip install --no-deps --require-hashes -r <this file>")
+        for req in requirements:
+            dldir = os.path.join(tmpdir, req)
+            os.mkdir(dldir)
+            subprocess.check_call(
+                [pip, 'download', '--no-deps', '--quiet', '-d', dldir, req],
+                stdout=sys.stderr)
+
+            hashes = list()
+            for fn in sorted(os.listdir(dldir)):
+                output = subprocess.check_output(
+                    [pip, 'hash', os.path.join(dldir, fn)],
+                    universal_newlines=True)
+                hashes.extend(
+                    line.strip() for line in output.split('\n')
+                    if line.strip().startswith('--hash='))
+
+            print(' \\\n    '.join([req, ] + hashes))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
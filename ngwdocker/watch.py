@@ -0,0 +1,238 @@
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from pathlib import Path
+from time import monotonic, perf_counter, sleep
+
+from loguru import logger
+
+from .context import Context
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+    | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# Files of a package which affect generated files
+PACKAGE_FILES = ('docker.py', 'setup.py', 'setup.cfg', 'VERSION')
+
+TEMPLATE_PATH = Path(__file__).parent / 'base' / 'image'
+
+
+class Inotify:
+    """ Minimal inotify binding via ctypes, directories are watched
+    non-recursively. """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.wds = dict()
+
+    def add(self, path):
+        if path in self.wds.values():
+            return
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(str(path)), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOENT:
+                return
+            raise OSError(err, "inotify_add_watch failed for {}".format(path))
+        self.wds[wd] = path
+
+    def read(self, timeout):
+        """ Wait up to timeout seconds and return list of changed paths """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        result = list()
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            parent = self.wds.get(wd)
+            if parent is None:
+                continue
+            path = parent / os.fsdecode(name) if name else parent
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add(path)
+            result.append(path)
+
+        return result
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """ Fallback for platforms without inotify: compares mtimes of watched
+    directory entries. """
+
+    interval = 1.0
+
+    def __init__(self):
+        self.dirs = list()
+        self.state = dict()
+
+    def add(self, path):
+        if path not in self.dirs and path.is_dir():
+            self.dirs.append(path)
+            self.state.update(self._scan(path))
+
+    def _scan(self, path):
+        result = dict()
+        for p in path.iterdir():
+            try:
+                result[p] = p.stat().st_mtime
+            except FileNotFoundError:
+                pass
+        return result
+
+    def read(self, timeout):
+        sleep(min(timeout, self.interval))
+        state = dict()
+        for d in list(self.dirs):
+            if d.is_dir():
+                state.update(self._scan(d))
+        changed = [
+            p for p in set(state) | set(self.state)
+            if state.get(p) != self.state.get(p)]
+        self.state = state
+        for p in changed:
+            if p.is_dir():
+                self.add(p)
+        return changed
+
+    def close(self):
+        pass
+
+
+def affected_images(paths, config_path, package_path):
+    """ Names of images which have to be regenerated for changed paths, None
+    means full regeneration and empty set means nothing to do. """
+
+    result = set()
+    for path in paths:
+        path = Path(os.path.abspath(str(path)))
+        if path == config_path:
+            return None
+
+        try:
+            sub = path.relative_to(package_path).parts
+        except ValueError:
+            sub = None
+        if sub is not None:
+            if len(sub) == 1:
+                # Package added or removed
+                return None
+            elif len(sub) == 2 and sub[1] == 'docker.py':
+                # Handlers can change any image
+                return None
+            elif len(sub) == 2 and sub[1] in PACKAGE_FILES:
+                result.add('app')
+            continue
+
+        try:
+            sub = path.relative_to(TEMPLATE_PATH).parts
+        except ValueError:
+            sub = None
+        if sub is not None and len(sub) > 1:
+            result.add(sub[0])
+
+    return result
+
+
+def regenerate(config_path, images=None):
+    start = perf_counter()
+    context = Context.from_file(config_path)
+    context.load_packages()
+    context.initialize(images=images)
+    logger.info(
+        "Regenerated [{}] in {:.3f}s",
+        'all' if images is None else ', '.join(sorted(images)),
+        perf_counter() - start)
+    return context
+
+
+def watch(config_path, debounce=0.2):
+    config_path = Path(os.path.abspath(str(config_path)))
+    package_path = config_path.parent / 'package'
+
+    try:
+        watcher = Inotify()
+    except (OSError, AttributeError):
+        logger.warning("Inotify isn't available, falling back to polling")
+        watcher = Poller()
+
+    def add_watches():
+        watcher.add(config_path.parent)
+        watcher.add(package_path)
+        if package_path.is_dir():
+            for p in package_path.iterdir():
+                if p.is_dir() and not p.name.startswith('.'):
+                    watcher.add(p)
+        for root, dirs, files in os.walk(str(TEMPLATE_PATH)):
+            watcher.add(Path(root))
+
+    add_watches()
+    regenerate(config_path)
+
+    logger.info("Watching for changes, press Ctrl+C to stop...")
+    try:
+        while True:
+            changed = watcher.read(None if isinstance(watcher, Inotify) else 1.0)
+            if len(changed) == 0:
+                continue
+
+            # Collect events until there are no new ones during debounce
+            deadline = monotonic() + debounce
+            while monotonic() < deadline:
+                more = watcher.read(max(deadline - monotonic(), 0))
+                if more:
+                    changed.extend(more)
+                    deadline = monotonic() + debounce
+
+            images = affected_images(changed, config_path, package_path)
+            if images is not None and len(images) == 0:
+                continue
+
+            for p in sorted(set(changed)):
+                logger.debug("Changed [{}]", p)
+
+            try:
+                regenerate(config_path, images)
+            except Exception:
+                logger.exception("Regeneration failed")
+
+            add_watches()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()